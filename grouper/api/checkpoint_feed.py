@@ -0,0 +1,80 @@
+import json
+import logging
+
+from expvar.stats import stats
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+# How often to write a comment line to idle streams, so that proxies don't time them out and
+# clients that have gone away are noticed.
+KEEPALIVE_INTERVAL_MS = 15 * 1000
+
+
+def checkpoint_event(snapshot, since):
+    """Format a server-sent event announcing the snapshot's checkpoint, with the names of the
+    users, groups and permissions that changed since the given one. If the snapshot can't say
+    what changed, the event has "resync" set instead and the client should start over."""
+    data = {
+        "checkpoint": snapshot.checkpoint,
+        "checkpoint_time": snapshot.checkpoint_time,
+        "since": since,
+    }
+    changes = None if since is None else snapshot.get_changes_since(since)
+    if changes is None:
+        data["resync"] = True
+    else:
+        data.update({
+            "resync": False,
+            "users": sorted(changes.users),
+            "groups": sorted(changes.groups),
+            "permissions": sorted(changes.permissions),
+        })
+    # The id lets a reconnecting EventSource pick up where it left off via Last-Event-ID.
+    return "id: {}\nevent: checkpoint\ndata: {}\n\n".format(snapshot.checkpoint, json.dumps(data))
+
+
+class CheckpointFeed(object):
+    """Pushes each new graph snapshot to every open checkpoint stream.
+
+    Streams are plain connections parked on the IOLoop, so idle clients cost a socket and a
+    little memory each rather than a thread. The graph calls us from the refresh thread, and we
+    hop over to the IOLoop before touching any of them.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.logger = logging.getLogger(__name__)
+        self.streams = set()
+        self.io_loop = None
+        self.keepalive = None
+
+    def subscribe(self, stream):
+        # Started on the first subscriber, from the IOLoop the streams are served on.
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+            self.graph.add_listener(self._on_update)
+            self.keepalive = PeriodicCallback(
+                self._send_keepalive, KEEPALIVE_INTERVAL_MS, io_loop=self.io_loop)
+            self.keepalive.start()
+        self.streams.add(stream)
+        stats.set_gauge("checkpoint-streams", len(self.streams))
+
+    def unsubscribe(self, stream):
+        self.streams.discard(stream)
+        stats.set_gauge("checkpoint-streams", len(self.streams))
+
+    def stop(self):
+        if self.io_loop is not None:
+            self.graph.remove_listener(self._on_update)
+            self.keepalive.stop()
+            self.io_loop = None
+
+    def _on_update(self, snapshot):
+        self.io_loop.add_callback(self._publish, snapshot)
+
+    def _publish(self, snapshot):
+        for stream in list(self.streams):
+            stream.send_snapshot(snapshot)
+
+    def _send_keepalive(self):
+        for stream in list(self.streams):
+            stream.send_comment("keepalive")
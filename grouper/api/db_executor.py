@@ -0,0 +1,56 @@
+from multiprocessing.pool import ThreadPool
+import sys
+from threading import Lock
+from time import time
+
+from expvar.stats import stats
+from tornado.concurrent import TracebackFuture
+from tornado.ioloop import IOLoop
+
+
+class DbExecutor(object):
+    """Runs the database work of API handlers on a fixed pool of threads, so that a slow query
+    holds up only the request waiting for it rather than the whole IOLoop.
+
+    The number of calls queued or running is kept in the "db-executor-queue-depth" gauge. Each
+    call adds to "db-executor-calls", and the milliseconds it waited for a free thread to
+    "db-executor-wait-ms".
+    """
+
+    def __init__(self, threads):
+        self.pool = ThreadPool(threads)
+        self.lock = Lock()
+        self.queue_depth = 0
+
+    def submit(self, fn, *args):
+        """Call fn(*args) on one of the threads, returning a Future for its result that's
+        resolved on the calling thread's IOLoop."""
+        future = TracebackFuture()
+        io_loop = IOLoop.current()
+        queued_at = time()
+        self._add_to_queue_depth(1)
+
+        def run():
+            stats.incr("db-executor-calls")
+            stats.incr("db-executor-wait-ms", int((time() - queued_at) * 1000))
+            try:
+                try:
+                    result = fn(*args)
+                finally:
+                    self._add_to_queue_depth(-1)
+            except Exception:
+                io_loop.add_callback(future.set_exc_info, sys.exc_info())
+            else:
+                io_loop.add_callback(future.set_result, result)
+
+        self.pool.apply_async(run)
+        return future
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _add_to_queue_depth(self, delta):
+        with self.lock:
+            self.queue_depth += delta
+            stats.set_gauge("db-executor-queue-depth", self.queue_depth)
@@ -1,20 +1,30 @@
 from cStringIO import StringIO
 import csv
 from datetime import datetime
+import functools
+import hashlib
+from itertools import islice
+import json
 import re
 import sys
 import traceback
+import zlib
 
 from expvar.stats import stats
-import sshpubkey
-from tornado.web import HTTPError, RequestHandler
+from sqlalchemy import event
+from tornado import gen
+from tornado.concurrent import TracebackFuture
+from tornado.web import asynchronous, HTTPError, RequestHandler
 
+from grouper.api.checkpoint_feed import checkpoint_event
+from grouper.api.settings import settings
 from grouper.constants import TOKEN_FORMAT
-from grouper.models.base.session import Session
+from grouper.graph import TokenTuple
 from grouper.models.public_key import PublicKey
 from grouper.models.user import User
 from grouper.models.user_token import UserToken
-from grouper.public_key import get_public_key_permissions
+from grouper.public_key import get_public_key_comment
+from grouper.query_stats import QueryStats
 from grouper.util import try_update
 
 # if raven library around, pull in SentryMixin
@@ -27,17 +37,126 @@ else:
         pass
     RequestHandler = SentryHandler
 
+# How many lines /export and /public-keys write between flushes. Each flush waits for the client
+# to take the previous chunk, so this is roughly how much of the export is held in memory at once.
+EXPORT_CHUNK_LINES = 100
+
+
+def cached_response(kind):
+    """Decorate the get(name=None) of a handler for the given kind ("users", "groups" or
+    "permissions") to answer conditional requests with not_modified, and to reuse the body of an
+    identical earlier request at the same checkpoint from the application's response cache, if
+    it has one. Only successful responses are cached."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, name=None):
+            if self.not_modified(kind, name):
+                return
+
+            cache = self.application.my_settings.get("response_cache")
+            if cache is None:
+                return method(self, name)
+
+            args = tuple(sorted(
+                (arg, tuple(values)) for arg, values in self.request.query_arguments.iteritems()))
+            key = (self.request.path, args, self.snapshot.checkpoint)
+            body = cache.get(key)
+            if body is not None:
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
+                return self.write(body)
+
+            method(self, name)
+            if self.get_status() == 200:
+                cache.set(key, b"".join(self._write_buffer))
+        return wrapper
+    return decorator
+
 
 class GraphHandler(RequestHandler):
     def initialize(self):
         self.graph = self.application.my_settings.get("graph")
-        self.session = self.application.my_settings.get("db_session")()
+        # Everything this request reads from the graph, including the checkpoint it reports,
+        # comes from the one snapshot taken here.
+        self.snapshot = self.graph.snapshot
+        self._session = None
+        self.query_stats = QueryStats()
+        self._connection_closed = False
+        self._flush_waiter = None
+        self._db_calls = 0
 
         self._request_start_time = datetime.utcnow()
         stats.incr("requests")
         stats.incr("requests_{}".format(self.__class__.__name__))
 
+    @property
+    def session(self):
+        """The request's database session, opened on first use so that requests served from
+        the graph don't take one at all, and closed when the request finishes."""
+        if self._session is None:
+            name = self.__class__.__name__
+            stats.incr("db_sessions")
+            stats.incr("db_sessions_{}".format(name))
+
+            # A session checks a connection out of the pool for each transaction it begins.
+            def count_checkout(session, transaction, connection):
+                stats.incr("db_checkouts")
+                stats.incr("db_checkouts_{}".format(name))
+                self.query_stats.attach(connection)
+
+            self._session = self.application.my_settings.get("db_session")()
+            self._count_checkout = count_checkout
+            event.listen(self._session, "after_begin", count_checkout)
+        return self._session
+
+    def close_session(self):
+        if self._session is not None:
+            event.remove(self._session, "after_begin", self._count_checkout)
+            self._session.close()
+            self._session = None
+
+    def flush_chunk(self):
+        """Send what's been written so far, returning a Future that resolves to True once it's
+        gone out, or to False if the client has gone away and the caller should stop writing.
+        Once the connection is closed tornado never calls back from a flush, so streaming
+        handlers would otherwise wait forever, holding on to their snapshot."""
+        future = TracebackFuture()
+        if self._connection_closed:
+            future.set_result(False)
+            return future
+
+        def on_flushed():
+            if not future.done():
+                future.set_result(True)
+
+        self._flush_waiter = future
+        self.flush(callback=on_flushed)
+        return future
+
+    def on_connection_close(self):
+        self._connection_closed = True
+        if self._flush_waiter is not None and not self._flush_waiter.done():
+            self._flush_waiter.set_result(False)
+        # Give back the session, with any cursor it has open and its pooled connection, without
+        # waiting for the request to wind up. If a query on the DB executor is still using it,
+        # it's closed when the request finishes instead.
+        if not self._db_calls:
+            self.close_session()
+
+    def finish(self, chunk=None):
+        # In debug mode, report the request's SQL statements unless the headers already went out
+        # with the first chunk of a streamed response.
+        if self.settings.get("debug") and not self._headers_written:
+            self.set_header("X-Grouper-Queries", self.query_stats.summary())
+        return super(GraphHandler, self).finish(chunk)
+
     def on_finish(self):
+        self.close_session()
+        self.query_stats.report(
+            self.__class__.__name__,
+            "{} {}".format(self.request.method, self.request.uri),
+            settings.request_query_log_threshold,
+        )
+
         # log request duration
         duration = datetime.utcnow() - self._request_start_time
         duration_ms = int(duration.total_seconds() * 1000)
@@ -53,26 +172,138 @@ class GraphHandler(RequestHandler):
         errors = [
             {"code": code, "message": message} for code, message in errors
         ]
-        with self.graph.lock:
-            checkpoint = self.graph.checkpoint
-            checkpoint_time = self.graph.checkpoint_time
-            self.write({
-                "status": "error",
-                "errors": errors,
-                "checkpoint": checkpoint,
-                "checkpoint_time": checkpoint_time,
-            })
+        checkpoint = self.snapshot.checkpoint
+        checkpoint_time = self.snapshot.checkpoint_time
+        self.write({
+            "status": "error",
+            "errors": errors,
+            "checkpoint": checkpoint,
+            "checkpoint_time": checkpoint_time,
+        })
 
     def success(self, data):
-        with self.graph.lock:
-            checkpoint = self.graph.checkpoint
-            checkpoint_time = self.graph.checkpoint_time
-            self.write({
-                "status": "ok",
-                "data": data,
-                "checkpoint": checkpoint,
-                "checkpoint_time": checkpoint_time,
-            })
+        checkpoint = self.snapshot.checkpoint
+        checkpoint_time = self.snapshot.checkpoint_time
+        self.write({
+            "status": "ok",
+            "data": data,
+            "checkpoint": checkpoint,
+            "checkpoint_time": checkpoint_time,
+        })
+
+    def not_modified(self, kind=None, name=None):
+        """Tag the response with an ETag for the version of the named entity of the given kind,
+        or for the checkpoint if no name is given. If the client already has that version,
+        respond with 304 and return True, and the caller shouldn't go on to build the output.
+
+        The tag is weak since the output also includes the checkpoint, which moves on anyway."""
+        version = self.snapshot.get_version(kind, name) if name else self.snapshot.checkpoint
+        etag = 'W/"{}-{}"'.format(version, hashlib.md5(self.request.uri).hexdigest()[:16])
+        self.set_header("Etag", etag)
+
+        if_none_match = [
+            tag.strip() for tag in self.request.headers.get("If-None-Match", "").split(",")]
+        if etag in if_none_match or "*" in if_none_match:
+            self.set_status(304)
+            return True
+        return False
+
+    def changes_since(self, since, kind, get_entity, include=None):
+        """Respond with the current output of each entity of the given kind that has changed
+        since the given checkpoint, or null for those that have gone away. If the snapshot can't
+        tell what changed, responds with "resync" set and the client must fetch everything.
+        Entities for which include(name) is false are left out altogether, since null would
+        tell the client they'd been deleted."""
+        try:
+            since = int(since)
+        except ValueError:
+            return self.bad_checkpoint(since)
+
+        changes = self.snapshot.get_changes_since(since)
+        if changes is None:
+            return self.success({"since": since, "resync": True})
+        return self.success({
+            "since": since,
+            "resync": False,
+            kind: {
+                name: get_entity(name)
+                for name in getattr(changes, kind)
+                if include is None or include(name)
+            },
+        })
+
+    def bad_checkpoint(self, since):
+        self.set_status(400)
+        self.error([(400, "Checkpoint (%s) should be an integer." % since)])
+
+    def get_user(self, name, cutoff, include_role_users=True, cached=True):
+        """The output for one user, or None if there's no such user. cached=False keeps the
+        details out of the snapshot's shared cache, for requests that walk every entity."""
+        md = self.snapshot.user_metadata.get(name)
+        if md is None or (md["role_user"] and not include_role_users):
+            return None
+        details = self.snapshot.get_user_details(name, cutoff, cached=cached)
+
+        # The snapshot is shared with other requests, so add permissions to copies of its keys.
+        key_permissions = self.snapshot.public_key_permissions.get(name, {})
+        public_keys = [
+            dict(key, permissions=key_permissions.get(key["id"], []))
+            for key in md["public_keys"]
+        ]
+
+        out = {"user": {"name": name}}
+        try_update(out["user"], dict(md, public_keys=public_keys))
+        try_update(out, details)
+        return out
+
+    def get_group(self, name, cutoff, cached=True):
+        """The output for one group, or None if there's no such group."""
+        if name not in self.snapshot.groups:
+            return None
+
+        details = self.snapshot.get_group_details(name, cutoff, cached=cached)
+
+        out = {"group": {"name": name}}
+        try_update(out["group"], self.snapshot.group_metadata.get(name, {}))
+        try_update(out, details)
+        return out
+
+    def get_permission(self, name, cached=True):
+        """The output for one permission, or None if there's no such permission."""
+        if name not in self.snapshot.permissions:
+            return None
+
+        details = self.snapshot.get_permission_details(name, cached=cached)
+
+        out = {"permission": {"name": name}}
+        try_update(out, details)
+        return out
+
+    def run_db(self, fn, *args):
+        """Call fn(*args), which does database work, on the application's DB executor and
+        return a Future for its result. Without an executor, it's called right away."""
+        executor = self.application.my_settings.get("db_executor")
+        if executor is not None:
+            self._db_calls += 1
+            future = executor.submit(fn, *args)
+            future.add_done_callback(self._db_call_done)
+            return future
+
+        future = TracebackFuture()
+        try:
+            future.set_result(fn(*args))
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        return future
+
+    def _db_call_done(self, future):
+        self._db_calls -= 1
+
+    def batch(self, kind, get_entity):
+        """Respond with the output of each entity of the given kind named by a "name" body
+        argument, or null for those that don't exist. All of them come from the one snapshot."""
+        names = self.get_body_arguments("name")
+        return self.success({kind: {name: get_entity(name) for name in names}})
 
     def raise_and_log_exception(self, exc):
         try:
@@ -95,141 +326,319 @@ class GraphHandler(RequestHandler):
 
 
 class Users(GraphHandler):
+    @cached_response("users")
     def get(self, name=None):
         cutoff = int(self.get_argument("cutoff", 100))
         include_role_users = self.get_argument("include_role_users", "no") == "yes"
 
-        with self.graph.lock:
-            if not name:
-                return self.success({
-                    "users": sorted([k
-                                     for k, v in self.graph.user_metadata.iteritems()
-                                     if include_role_users or (not v["role_user"])]),
-                })
-
-            if name in self.graph.user_metadata:
-                md = self.graph.user_metadata[name]
-                details = self.graph.get_user_details(name, cutoff)
-            else:
-                return self.notfound("User (%s) not found." % name)
-            for key in md["public_keys"]:
-                db_key = PublicKey.get(self.session, id=key["id"])
-                perms = get_public_key_permissions(self.session, db_key)
+        if not name:
+            since = self.get_argument("since", None)
+            if since is not None:
+                # Users that have gone away are still reported, whatever they were.
+                def listed(name):
+                    md = self.snapshot.user_metadata.get(name)
+                    return include_role_users or md is None or not md["role_user"]
+
+                return self.changes_since(
+                    since, "users",
+                    lambda name: self.get_user(name, cutoff, include_role_users),
+                    include=listed)
+            return self.success({
+                "users": sorted([k
+                                 for k, v in self.snapshot.user_metadata.iteritems()
+                                 if include_role_users or (not v["role_user"])]),
+            })
 
-                # Convert to set to remove duplicates, then back to list for json-serializability
-                key["permissions"] = list(set([(perm.name, perm.argument) for perm in perms]))
+        out = self.get_user(name, cutoff)
+        if out is None:
+            return self.notfound("User (%s) not found." % name)
+        return self.success(out)
 
-            out = {"user": {"name": name}}
-            try_update(out["user"], md)
-            try_update(out, details)
-            return self.success(out)
+    def post(self, name=None):
+        # Routed here as /users/{name}, so that GET still works for a user called "batch".
+        if name != "batch":
+            return self.notfound("Endpoint not found")
+        cutoff = int(self.get_argument("cutoff", 100))
+        include_role_users = self.get_argument("include_role_users", "yes") == "yes"
+        return self.batch(
+            "users", lambda name: self.get_user(name, cutoff, include_role_users))
 
 
 class UsersPublicKeys(GraphHandler):
+    """Every public key as CSV, written a chunk at a time as the client reads it. Can be limited
+    to keys of enabled users (include_disabled=no), of one type (key_type) or created on or
+    after a date (since, as YYYY-MM-DD)."""
+
+    @gen.coroutine
     def get(self):
-        fh = StringIO()
-        w_csv = csv.writer(fh, lineterminator="\n")
+        since = self.get_argument("since", None)
+        if since is not None:
+            try:
+                since = datetime.strptime(since, "%Y-%m-%d")
+            except ValueError:
+                self.set_status(400)
+                self.error([(400, "Date (%s) should be YYYY-MM-DD." % since)])
+                return
+
+        keys = self.session.query(
+            User.username,
+            PublicKey.created_on,
+            PublicKey.key_type,
+            PublicKey.key_size,
+            PublicKey.fingerprint,
+            PublicKey.public_key,
+        ).filter(
+            User.id == PublicKey.user_id,
+        )
+        if self.get_argument("include_disabled", "yes") != "yes":
+            keys = keys.filter(User.enabled == True)
+        key_type = self.get_argument("key_type", None)
+        if key_type is not None:
+            keys = keys.filter(PublicKey.key_type == key_type)
+        if since is not None:
+            keys = keys.filter(PublicKey.created_on >= since)
 
-        # header
-        w_csv.writerow([
+        self.set_header("Content-Type", "text/csv")
+        self.write_rows([[
             'username',
             'created_at',
             'type',
             'size',
             'fingerprint',
             'comment',
+        ]])
+
+        # Starting the iteration runs the query, so that's done on the executor too.
+        rows = yield self.run_db(lambda: iter(keys.yield_per(EXPORT_CHUNK_LINES)))
+        while True:
+            chunk = yield self.run_db(lambda: list(islice(rows, EXPORT_CHUNK_LINES)))
+            if not chunk:
+                break
+            self.write_rows([
+                [
+                    username,
+                    created_on.isoformat(),
+                    row_key_type,
+                    key_size,
+                    fingerprint,
+                    get_public_key_comment(public_key),
+                ]
+                for username, created_on, row_key_type, key_size, fingerprint, public_key in chunk
             ])
+            flushed = yield self.flush_chunk()
+            if not flushed:
+                return
 
-        user_key_list = Session().query(PublicKey, User).filter(User.id == PublicKey.user_id)
-        for key, user in user_key_list:
-            w_csv.writerow([
-                user.name,
-                key.created_on.isoformat(),
-                key.key_type,
-                key.key_size,
-                key.fingerprint,
-                sshpubkey.PublicKey.from_str(key.public_key).comment,
-                ])
-
-        self.set_header("Content-Type", "text/csv")
+    def write_rows(self, rows):
+        fh = StringIO()
+        csv.writer(fh, lineterminator="\n").writerows(rows)
         self.write(fh.getvalue())
 
 
 class Groups(GraphHandler):
+    @cached_response("groups")
     def get(self, name=None):
         cutoff = int(self.get_argument("cutoff", 100))
 
-        with self.graph.lock:
-            if not name:
-                return self.success({
-                    "groups": [
-                        group
-                        for group in self.graph.groups
-                    ],
-                })
-
-            if name not in self.graph.groups:
-                return self.notfound("Group (%s) not found." % name)
+        if not name:
+            since = self.get_argument("since", None)
+            if since is not None:
+                return self.changes_since(
+                    since, "groups", lambda name: self.get_group(name, cutoff))
+            return self.success({
+                "groups": [
+                    group
+                    for group in self.snapshot.groups
+                ],
+            })
 
-            details = self.graph.get_group_details(name, cutoff)
+        out = self.get_group(name, cutoff)
+        if out is None:
+            return self.notfound("Group (%s) not found." % name)
+        return self.success(out)
 
-            out = {"group": {"name": name}}
-            try_update(out["group"], self.graph.group_metadata.get(name, {}))
-            try_update(out, details)
-            return self.success(out)
+    def post(self, name=None):
+        if name != "batch":
+            return self.notfound("Endpoint not found")
+        cutoff = int(self.get_argument("cutoff", 100))
+        return self.batch("groups", lambda name: self.get_group(name, cutoff))
 
 
 class Permissions(GraphHandler):
+    @cached_response("permissions")
     def get(self, name=None):
-        with self.graph.lock:
-            if not name:
-                return self.success({
-                    "permissions": [
-                        permission
-                        for permission in self.graph.permissions
-                    ],
-                })
+        if not name:
+            since = self.get_argument("since", None)
+            if since is not None:
+                return self.changes_since(since, "permissions", self.get_permission)
+            return self.success({
+                "permissions": [
+                    permission
+                    for permission in self.snapshot.permissions
+                ],
+            })
+
+        out = self.get_permission(name)
+        if out is None:
+            return self.notfound("Permission (%s) not found." % name)
+        return self.success(out)
 
-            if name not in self.graph.permissions:
-                return self.notfound("Permission (%s) not found." % name)
 
-            details = self.graph.get_permission_details(name)
+class Export(GraphHandler):
+    """The whole snapshot as JSON lines: one {"type": ..., "name": ..., "data": ...} object per
+    user, group and permission, where data is what /users/{name} etc. would return. Written a
+    chunk at a time as the client reads it, and gzipped if the client accepts that. The details
+    are worked out without the snapshot's shared cache, which one export would otherwise flush
+    of everything other requests use."""
+
+    @gen.coroutine
+    def get(self):
+        if self.not_modified():
+            return
+
+        cutoff = int(self.get_argument("cutoff", 100))
+
+        self.set_header("Content-Type", "application/x-json-stream")
+        self.set_header("X-Grouper-Checkpoint", str(self.snapshot.checkpoint))
+        self.set_header("X-Grouper-Checkpoint-Time", str(self.snapshot.checkpoint_time))
+        self.set_header("Vary", "Accept-Encoding")
+        compressor = None
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        lines = []
+        for line in self.get_lines(cutoff):
+            lines.append(line)
+            if len(lines) >= EXPORT_CHUNK_LINES:
+                self.write_lines(lines, compressor)
+                lines = []
+                flushed = yield self.flush_chunk()
+                if not flushed:
+                    return
+        self.write_lines(lines, compressor)
+        if compressor:
+            self.write(compressor.flush())
+
+    def get_lines(self, cutoff):
+        entities = [
+            ("user", sorted(self.snapshot.user_metadata),
+             lambda name: self.get_user(name, cutoff, cached=False)),
+            ("group", sorted(self.snapshot.groups),
+             lambda name: self.get_group(name, cutoff, cached=False)),
+            ("permission", sorted(self.snapshot.permissions),
+             lambda name: self.get_permission(name, cached=False)),
+        ]
+        for kind, names, get_entity in entities:
+            for name in names:
+                data = get_entity(name)
+                yield json.dumps({"type": kind, "name": name, "data": data}) + "\n"
 
-            out = {"permission": {"name": name}}
-            try_update(out, details)
-            return self.success(out)
+    def write_lines(self, lines, compressor):
+        chunk = "".join(lines)
+        if compressor:
+            chunk = compressor.compress(chunk)
+        self.write(chunk)
 
 
 class TokenValidate(GraphHandler):
     validator = re.compile(TOKEN_FORMAT)
 
+    @gen.coroutine
     def post(self):
         supplied_token = self.get_body_argument("token")
         match = TokenValidate.validator.match(supplied_token)
         if not match:
-            return self.error(((1, "Token format not recognized"),))
-
-        sess = Session()
+            self.error(((1, "Token format not recognized"),))
+            return
 
+        owner_name = match.group("name")
         token_name = match.group("token_name")
         token_secret = match.group("token_secret")
-        owner = User.get(sess, name=match.group("name"))
 
-        token = UserToken.get(sess, owner, token_name)
+        # The snapshot can be as old as the refresh interval, so anything it doesn't vouch for
+        # is checked against the database in case the token was created or changed since.
+        token = self.snapshot.user_tokens.get(owner_name, {}).get(token_name)
+        if token is None or not token.enabled or not UserToken.secret_matches(
+                token.hashed_secret, token_secret):
+            stats.incr("token-validate-db")
+            owner_name, token_name, token = yield self.run_db(
+                self.get_token_from_db, owner_name, token_name)
+
         if token is None:
-            return self.error(((2, "Token specified does not exist"),))
+            self.error(((2, "Token specified does not exist"),))
+            return
         if not token.enabled:
-            return self.error(((3, "Token is disabled"),))
-        if not token.check_secret(token_secret):
-            return self.error(((4, "Token secret mismatch"),))
-
-        return self.success({
-            "owner": owner.username,
-            "identity": str(token),
+            self.error(((3, "Token is disabled"),))
+            return
+        if not UserToken.secret_matches(token.hashed_secret, token_secret):
+            self.error(((4, "Token secret mismatch"),))
+            return
+
+        self.success({
+            "owner": owner_name,
+            "identity": "{}/{}".format(owner_name, token_name),
             "act_as_owner": True,
             "valid": True,
         })
 
+    def get_token_from_db(self, owner_name, token_name):
+        """Look up the named token in the database, returning its owner's name and its own as
+        stored there along with its TokenTuple, or the given names and None if there's no such
+        token."""
+        owner = User.get(self.session, name=owner_name)
+        token = UserToken.get(self.session, owner, token_name) if owner else None
+        if token is None:
+            return owner_name, token_name, None
+        return owner.username, token.name, TokenTuple(
+            hashed_secret=token.hashed_secret, enabled=token.enabled)
+
+
+class CheckpointStream(GraphHandler):
+    """A server-sent event stream with an event for the current checkpoint followed by one for
+    each new checkpoint as soon as it's loaded. Each event lists what changed since the last,
+    starting from the "since" argument (or Last-Event-ID header) if given."""
+
+    @asynchronous
+    def get(self):
+        since = self.request.headers.get("Last-Event-ID") or self.get_argument("since", None)
+        try:
+            self.last_checkpoint = int(since) if since is not None else None
+        except ValueError:
+            self.bad_checkpoint(since)
+            self.finish()
+            return
+        self.feed = self.application.my_settings.get("checkpoint_feed")
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.send_snapshot(self.snapshot, force=True)
+        # The stream may stay open through many refreshes, and only needs last_checkpoint from
+        # here on, so let go of the snapshot rather than keeping it alive for as long.
+        self.snapshot = None
+        self.feed.subscribe(self)
+
+    def send_snapshot(self, snapshot, force=False):
+        if snapshot.checkpoint == self.last_checkpoint and not force:
+            return
+        self.write(checkpoint_event(snapshot, self.last_checkpoint))
+        self.flush()
+        self.last_checkpoint = snapshot.checkpoint
+
+    def send_comment(self, comment):
+        self.write(": {}\n\n".format(comment))
+        self.flush()
+
+    def on_connection_close(self):
+        super(CheckpointStream, self).on_connection_close()
+        self.feed.unsubscribe(self)
+
+    def on_finish(self):
+        # Streams stay open for as long as the client likes, so they'd swamp the request
+        # duration stats.
+        self.feed.unsubscribe(self)
+        self.close_session()
+
 
 class NotFound(GraphHandler):
     def get(self):
@@ -1,4 +1,6 @@
 from grouper.api.handlers import (
+        CheckpointStream,
+        Export,
         Groups,
         NotFound,
         Permissions,
@@ -24,6 +26,10 @@ HANDLERS = [
     (r"/permissions", Permissions),
     (r"/permissions/{}".format(PERMISSION_VALIDATION), Permissions),
 
+    (r"/checkpoints", CheckpointStream),
+
+    (r"/export", Export),
+
     (r"/debug/stats", Stats),
 
     (r"/.*", NotFound),
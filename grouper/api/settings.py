@@ -3,8 +3,11 @@ from ..settings import Settings, settings as base_settings
 
 settings = Settings.from_settings(base_settings, {
     "address": None,
+    "db_executor_threads": 4,
     "debug": False,
+    "num_processes": 1,
     "port": 8990,
     "refresh_interval": 60,
+    "response_cache_bytes": 64 * 1024 * 1024,
     "url": "http://127.0.0.1:8888",
 })
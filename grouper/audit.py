@@ -93,8 +93,7 @@ def assert_can_join(group, user_or_group, role="member"):
 
     # Else, we have to check if the group is audited. If not, anybody can join.
     graph = Graph()
-    group_md = graph.get_group_details(group.name)
-    if not group_md["audited"]:
+    if not graph.is_group_audited(group.name):
         return True
 
     # Audited group. Easy case, let's see if we're checking a user. If so, the user must be
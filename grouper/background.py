@@ -18,6 +18,7 @@ from grouper.graph import Graph
 from grouper.group import get_audited_groups
 from grouper.model_soup import APPROVER_ROLE_INDICIES, Group, GroupEdge
 from grouper.models.base.session import get_db_engine, Session
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.user import User
 from grouper.perf_profile import prune_old_traces
 from grouper.settings import settings
@@ -26,6 +27,10 @@ from grouper.user_permissions import user_has_permission
 from grouper.util import get_database_url
 
 
+# Graphs whose checkpoint predates this window fall back to a full rebuild.
+GRAPH_CHANGE_RETENTION = timedelta(days=1)
+
+
 class BackgroundThread(Thread):
     """Background thread for running periodic tasks.
 
@@ -78,6 +83,7 @@ class BackgroundThread(Thread):
         for edge in edges:
             notify_edge_expiration(self.settings, session, edge)
             edge.active = False
+            GraphChange.record(session, GraphChangeType.membership, edge.group.groupname)
             session.commit()
 
     def expire_nonauditors(self, session):
@@ -132,6 +138,8 @@ class BackgroundThread(Thread):
                     process_async_emails(self.settings, session, datetime.utcnow())
                     self.logger.debug("Pruning old traces....")
                     prune_old_traces(session)
+                    self.logger.debug("Pruning old graph changes....")
+                    GraphChange.prune(session, datetime.utcnow() - GRAPH_CHANGE_RETENTION)
                     session.commit()
 
                 stats.set_gauge("successful-background-update", 1)
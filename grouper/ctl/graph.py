@@ -0,0 +1,59 @@
+import logging
+import resource
+from time import time
+
+from grouper.ctl.util import make_session
+from grouper.graph import GroupGraph
+from grouper.graph_backends import GRAPH_BACKENDS
+
+
+def benchmark(args):
+    session = make_session()
+
+    for backend in args.backend or sorted(GRAPH_BACKENDS):
+        start = time()
+        graph = GroupGraph.from_db(
+            session, backend=backend, loader_threads=args.loader_threads)
+        build_time = time() - start
+
+        start = time()
+        for _ in xrange(args.iterations):
+            for groupname in graph.groups:
+                graph.get_group_details(groupname)
+        group_time = time() - start
+
+        start = time()
+        for _ in xrange(args.iterations):
+            for username in graph.users:
+                graph.get_user_details(username)
+        user_time = time() - start
+
+        logging.info(
+            "%s: %d nodes, %d edges; build %.3fs, group details %.3fs, user details %.3fs, "
+            "max rss %d KiB",
+            backend, len(graph.nodes), len(graph.edges), build_time, group_time, user_time,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def graph_command(args):
+    if args.subcommand == "benchmark":
+        benchmark(args)
+
+
+def add_parser(subparsers):
+    graph_parser = subparsers.add_parser(
+        "graph", help="Inspect the in-memory graph.")
+    graph_parser.set_defaults(func=graph_command)
+    graph_subparser = graph_parser.add_subparsers(dest="subcommand")
+
+    benchmark_parser = graph_subparser.add_parser(
+        "benchmark", help="Time loading and querying the graph with each backend.")
+    benchmark_parser.add_argument(
+        "--backend", action="append", choices=sorted(GRAPH_BACKENDS),
+        help="Backend to benchmark; may be given more than once. Defaults to all of them.")
+    benchmark_parser.add_argument(
+        "--iterations", type=int, default=1,
+        help="Number of passes over every group and user.")
+    benchmark_parser.add_argument(
+        "--loader-threads", type=int, default=1,
+        help="Number of threads to load the graph with.")
@@ -4,6 +4,7 @@ import sys
 
 from grouper import __version__
 from grouper.ctl import (
+        graph,
         group,
         oneoff,
         shell,
@@ -36,6 +37,7 @@ def main(sys_argv=sys.argv, start_config_thread=True):
     subparsers = parser.add_subparsers(dest="command")
 
     for subcommand_module in [
+            graph,
             group,
             oneoff,
             shell,
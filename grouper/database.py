@@ -1,14 +1,76 @@
 from contextlib import closing
 import logging
+from multiprocessing import Pool
+import os
 from threading import Thread
 from time import sleep
 
 from expvar.stats import stats
 from sqlalchemy.exc import OperationalError
 
+from grouper.graph import GroupGraph
 from grouper.models.base.session import get_db_engine, Session
 from grouper.util import get_database_url
 
+# State of the graph refresh worker process. Only set in the worker itself.
+_worker = {}
+
+
+def _init_refresh_worker():
+    # The serving process's pooled connections came along with the fork. Keep a reference so
+    # they are never closed from here, which would close them for the serving process too.
+    _worker["inherited_bind"] = Session.kw.get("bind")
+    _worker["database_url"] = None
+    _worker["graph"] = GroupGraph()
+
+
+def _refresh_in_worker(database_url, backend, loader_threads, snapshot_path, checkpoint):
+    """Bring the worker's graph up to date and return it serialized, or None if the caller's
+    copy, at the given checkpoint, is already current."""
+    if database_url != _worker["database_url"]:
+        Session.configure(bind=get_db_engine(database_url))
+        _worker["database_url"] = database_url
+
+    graph = _worker["graph"]
+    if graph.checkpoint == 0 and snapshot_path:
+        graph.load_snapshot(snapshot_path)
+
+    snapshot = graph.snapshot
+    graph.backend = backend
+    graph.loader_threads = loader_threads
+    with closing(Session()) as session:
+        graph.update_from_db(session)
+    if snapshot_path and graph.snapshot is not snapshot:
+        graph.save_snapshot(snapshot_path)
+
+    if graph.checkpoint == checkpoint:
+        return None
+    return graph.dump_snapshot()
+
+
+class GraphRefreshWorker(object):
+    """Rebuilds the graph in a child process, so that the serving process only pays for
+    deserializing the result and swapping it in rather than holding the GIL for the whole
+    rebuild. The child keeps its own copy of the graph between refreshes, so it still applies
+    deltas when it can."""
+
+    def __init__(self):
+        self.pool = Pool(1, _init_refresh_worker)
+
+    def update(self, graph, settings):
+        """Update graph from the database by way of the worker. Returns whether it changed."""
+        data = self.pool.apply(_refresh_in_worker, (
+            get_database_url(settings), graph.backend, graph.loader_threads,
+            settings.graph_snapshot_path, graph.checkpoint))
+        if data is None:
+            return False
+        stats.incr("graph-worker-update")
+        return graph.load_snapshot_data(data)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
 
 class DbRefreshThread(Thread):
     """Background thread for refreshing the in-memory cache of the graph."""
@@ -18,18 +80,37 @@ class DbRefreshThread(Thread):
         self.refresh_interval = refresh_interval
         self.sentry_client = sentry_client
         self.logger = logging.getLogger(__name__)
+        # Started from here, before the thread runs, to fork while the process is quiet.
+        self.worker = GraphRefreshWorker() if settings.graph_refresh_process else None
         Thread.__init__(self, *args, **kwargs)
 
     def capture_exception(self):
         if self.sentry_client:
             self.sentry_client.captureException()
 
+    def save_snapshot(self):
+        try:
+            self.graph.save_snapshot(self.settings.graph_snapshot_path)
+        except (IOError, OSError):
+            self.logger.exception("Failed to save graph snapshot.")
+            stats.incr("graph-snapshot-save-failed")
+
     def run(self):
         while True:
             self.logger.debug("Updating Graph from Database.")
             try:
-                with closing(Session()) as session:
-                    self.graph.update_from_db(session)
+                # A backend change in the config takes effect as a full rebuild.
+                self.graph.backend = self.settings.graph_backend
+                self.graph.loader_threads = self.settings.graph_loader_threads
+                if self.worker:
+                    # The worker saves the snapshot file itself.
+                    self.worker.update(self.graph, self.settings)
+                else:
+                    snapshot = self.graph.snapshot
+                    with closing(Session()) as session:
+                        self.graph.update_from_db(session)
+                    if self.settings.graph_snapshot_path and self.graph.snapshot is not snapshot:
+                        self.save_snapshot()
 
                 stats.set_gauge("successful-db-update", 1)
             except OperationalError:
@@ -45,3 +126,39 @@ class DbRefreshThread(Thread):
                 raise
 
             sleep(self.refresh_interval)
+
+
+class SnapshotFollowThread(Thread):
+    """Background thread for keeping the in-memory graph in step with a snapshot file that
+    another process's DbRefreshThread saves, rather than refreshing it from the database.
+
+    Snapshot files are replaced by renaming a new one into place, so a new inode or mtime means
+    a complete new snapshot to load. The file as it is when the thread is created counts as
+    already loaded."""
+    def __init__(self, graph, path, poll_interval, *args, **kwargs):
+        self.graph = graph
+        self.path = path
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger(__name__)
+        self.last_stat = self._stat()
+        Thread.__init__(self, *args, **kwargs)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime)
+
+    def run(self):
+        while True:
+            sleep(self.poll_interval)
+            stat = self._stat()
+            if stat is None or stat == self.last_stat:
+                continue
+            # Either way, don't try the same file again; the next save replaces it.
+            self.last_stat = stat
+            if self.graph.load_snapshot(self.path):
+                stats.set_gauge("successful-snapshot-follow", 1)
+            else:
+                stats.set_gauge("successful-snapshot-follow", 0)
@@ -4,7 +4,7 @@ from grouper.fe.forms import GroupEditForm
 from grouper.fe.util import GrouperHandler
 from grouper.model_soup import Group
 from grouper.models.audit_log import AuditLog
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.service_account import is_service_account
 from grouper.user_group import user_can_manage_group
 
@@ -45,11 +45,14 @@ class GroupEdit(GrouperHandler):
                 alerts=self.get_form_alerts(form.errors)
             )
 
+        old_groupname = group.groupname
         group.groupname = form.data["groupname"]
         group.description = form.data["description"]
         group.canjoin = form.data["canjoin"]
         group.auto_expire = form.data["auto_expire"]
-        Counter.incr(self.session, "updates")
+        if group.groupname != old_groupname:
+            GraphChange.record(self.session, GraphChangeType.group, old_groupname)
+        GraphChange.record(self.session, GraphChangeType.group, group.groupname)
 
         try:
             self.session.commit()
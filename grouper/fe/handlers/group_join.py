@@ -22,12 +22,12 @@ class GroupJoin(GrouperHandler):
         if not group:
             return self.notfound()
 
-        group_md = self.graph.get_group_details(group.name)
+        audited = self.graph.is_group_audited(group.name)
 
         form = GroupJoinForm()
         form.member.choices = self._get_choices(group)
         return self.render(
-            "group-join.html", form=form, group=group, audited=group_md["audited"],
+            "group-join.html", form=form, group=group, audited=audited,
         )
 
     def post(self, group_id=None, name=None):
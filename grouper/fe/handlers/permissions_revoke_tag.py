@@ -1,7 +1,7 @@
 from grouper.constants import TAG_EDIT
 from grouper.fe.util import GrouperHandler
 from grouper.models.audit_log import AuditLog
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.tag_permission_map import TagPermissionMap
 from grouper.user_permissions import user_has_permission
 
@@ -30,7 +30,7 @@ class PermissionsRevokeTag(GrouperHandler):
         tag = mapping.tag
 
         mapping.delete(self.session)
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.tag, tag.name)
         self.session.commit()
 
         AuditLog.log(self.session, self.current_user.id, 'revoke_tag_permission',
@@ -4,7 +4,7 @@ from grouper.constants import TAG_EDIT
 from grouper.fe.forms import TagEditForm
 from grouper.fe.util import GrouperHandler
 from grouper.models.audit_log import AuditLog
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.public_key_tag import PublicKeyTag
 from grouper.user_permissions import user_has_permission
 
@@ -39,7 +39,7 @@ class TagEdit(GrouperHandler):
 
         tag.description = form.data["description"]
         tag.enabled = form.data["enabled"]
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.tag, tag.name)
 
         try:
             self.session.commit()
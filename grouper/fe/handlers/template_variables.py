@@ -30,7 +30,8 @@ def get_group_view_template_vars(session, actor, group, graph):
 
     ret["members"] = group.my_members()
     ret["groups"] = group.my_groups()
-    ret["permissions"] = group_md.get('permissions', [])
+    # Copied, since we add mapping_id below and the graph's results are shared.
+    ret["permissions"] = [dict(perm) for perm in group_md.get('permissions', [])]
 
     ret["permission_requests_pending"] = []
     for req in get_pending_request_by_group(session, group):
@@ -9,6 +9,7 @@ from uuid import uuid4
 
 from expvar.stats import stats
 from plop.collector import Collector
+from sqlalchemy import event
 import sqlalchemy.exc
 import tornado.web
 from tornado.web import RequestHandler
@@ -19,6 +20,7 @@ from grouper.fe.settings import settings
 from grouper.graph import Graph
 from grouper.models.base.session import get_db_engine, Session
 from grouper.models.user import User
+from grouper.query_stats import QueryStats
 from grouper.user_permissions import user_permissions
 from grouper.util import get_database_url
 
@@ -57,6 +59,15 @@ class GrouperHandler(RequestHandler):
         self.session = self.application.my_settings.get("db_session")()
         self.graph = Graph()
 
+        # Attribute the statements run in each of the session's transactions to this request.
+        self.query_stats = QueryStats()
+
+        def attach_query_stats(session, transaction, connection):
+            self.query_stats.attach(connection)
+
+        self._attach_query_stats = attach_query_stats
+        event.listen(self.session, "after_begin", attach_query_stats)
+
         if self.get_argument("_profile", False):
             self.perf_collector = Collector()
             self.perf_trace_uuid = str(uuid4())
@@ -145,7 +156,13 @@ class GrouperHandler(RequestHandler):
             self.perf_collector.stop()
             perf_profile.record_trace(self.session, self.perf_collector, self.perf_trace_uuid)
 
+        event.remove(self.session, "after_begin", self._attach_query_stats)
         self.session.close()
+        self.query_stats.report(
+            self.__class__.__name__,
+            "{} {}".format(self.request.method, self.request.uri),
+            settings.request_query_log_threshold,
+        )
 
         # log request duration
         duration = datetime.utcnow() - self._request_start_time
@@ -158,6 +175,12 @@ class GrouperHandler(RequestHandler):
         stats.incr("response_status_{}".format(response_status))
         stats.incr("response_status_{}_{}".format(self.__class__.__name__, response_status))
 
+    def finish(self, chunk=None):
+        # In debug mode, report the request's SQL statements.
+        if self.settings.get("debug") and not self._headers_written:
+            self.set_header("X-Grouper-Queries", self.query_stats.summary())
+        return super(GrouperHandler, self).finish(chunk)
+
     def update_qs(self, **kwargs):
         qs = self.request.arguments.copy()
         qs.update(kwargs)
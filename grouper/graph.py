@@ -1,24 +1,37 @@
 from collections import defaultdict, namedtuple
+from contextlib import closing
+from copy import copy
+import cPickle
 from datetime import datetime
+import gc
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+from tempfile import NamedTemporaryFile
 from threading import RLock
+from time import sleep
 
-from networkx import DiGraph, single_source_shortest_path
+from expvar.stats import stats
 from sqlalchemy import or_
 from sqlalchemy.orm import aliased
 from sqlalchemy.sql import label, literal
 
+from grouper.graph_backends import GRAPH_BACKENDS
 from grouper.model_soup import Group, GROUP_EDGE_ROLES, GroupEdge
+from grouper.models.base.session import Session
 from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.permission import MappedPermission, Permission
 from grouper.models.permission_map import PermissionMap
 from grouper.models.public_key import PublicKey
+from grouper.models.public_key_tag import PublicKeyTag
+from grouper.models.public_key_tag_map import PublicKeyTagMap
+from grouper.models.tag_permission_map import TagPermissionMap
 from grouper.models.user import User
 from grouper.models.user_metadata import UserMetadata
 from grouper.models.user_password import UserPassword
-from grouper.public_key import get_all_public_key_tags
-from grouper.service_account import is_service_account
-from grouper.util import singleton
+from grouper.models.user_token import UserToken
+from grouper.util import LRUCache, singleton
 
 
 MEMBER_TYPE_MAP = {
@@ -27,6 +40,32 @@ MEMBER_TYPE_MAP = {
 }
 EPOCH = datetime(1970, 1, 1)
 
+# Past this many checkpoints it's cheaper to rebuild than to apply the changes one by one.
+MAX_DELTA_CHANGES = 1000
+
+# Rows fetched at a time by the loaders, which stream columns rather than ORM objects.
+LOADER_BATCH_SIZE = 1000
+
+# Number of get_*_details results each snapshot keeps.
+DETAILS_CACHE_SIZE = 2000
+
+# Bump whenever GraphSnapshot or anything it holds changes shape, so that snapshots saved by an
+# older version are ignored rather than loaded.
+SNAPSHOT_FORMAT_VERSION = 9
+
+# Number of refreshes back that a snapshot can list the changes since.
+DELTA_HISTORY_SIZE = 100
+
+# Number of users whose closures are serialized together in each chunk of a snapshot.
+SNAPSHOT_CHUNK_SIZE = 1000
+
+# Change types that only touch a user's entry in user_metadata.
+USER_DATA_CHANGE_TYPES = {
+    GraphChangeType.public_key,
+    GraphChangeType.user_metadata,
+    GraphChangeType.user_password,
+}
+
 
 @singleton
 def Graph():  # noqa
@@ -42,6 +81,26 @@ GroupTuple = namedtuple(
     "GroupTuple",
     ["id", "groupname", "name", "description", "canjoin", "enabled", "service_account", "type"])
 
+# The transitive groups and effective permissions of a user, precomputed at refresh time so
+# get_user_details doesn't have to walk the graph. Paths are tuples of names starting with the
+# user, and granted_on is in seconds since the epoch.
+UserGroup = namedtuple("UserGroup", ["name", "path", "distance", "role"])
+UserPermission = namedtuple(
+    "UserPermission", ["permission", "argument", "granted_on", "path", "distance"])
+UserClosure = namedtuple("UserClosure", ["groups", "permissions"])
+
+# A permission allowed to a public key tag, or held by a public key. These have the name and
+# argument attributes that permission_intersection expects.
+KeyPermission = namedtuple("KeyPermission", ["name", "argument"])
+
+# What /token/validate needs to know about a user token. Enabled is false if either the token or
+# its owner is disabled.
+TokenTuple = namedtuple("TokenTuple", ["hashed_secret", "enabled"])
+
+# The names of the users, groups and permissions whose API output may differ between the
+# snapshots at checkpoints start and end.
+SnapshotDiff = namedtuple("SnapshotDiff", ["start", "end", "users", "groups", "permissions"])
+
 
 # Raise these exceptions when asking about users or groups that are not cached.
 class NoSuchUser(Exception):
@@ -52,41 +111,146 @@ class NoSuchGroup(Exception):
     pass
 
 
+def _from_snapshot(name):
+    """A read-only GroupGraph attribute that reads through to the current snapshot."""
+    return property(lambda self: getattr(self.snapshot, name))
+
+
 class GroupGraph(object):
-    def __init__(self):
+    def __init__(self, backend="networkx", loader_threads=1):
         self.logger = logging.getLogger(__name__)
-        self._graph = None
-        self._rgraph = None
-        self.lock = RLock()  # Graph structure.
+        self.backend = backend  # Key into GRAPH_BACKENDS, used on the next update.
+        self.loader_threads = loader_threads  # Above 1, full rebuilds query concurrently.
         self.update_lock = RLock()  # Limit to 1 updating thread at a time.
-        self.users = set()  # Enabled user names.
-        self.groups = set()  # Group names.
-        self.permissions = set()  # Permission names.
-        self.checkpoint = 0
-        self.checkpoint_time = 0
-        self.user_metadata = {}  # username -> {metaddata:[{}] public_keys:[{}]}.
-        self.group_metadata = {}
-        self.permission_metadata = {}  # TODO: rename.  This is about permission grants.
-        self.permission_tuples = set()  # Mock Permission instances.
-        self.group_tuples = {}  # groupname -> Mock Group instance.
-        self.disabled_group_tuples = {}  # groupname -> Mock Group instance.
+        self.last_change = None  # (id, created_on) of the GraphChange at our checkpoint.
+        self.snapshot = GraphSnapshot()  # Replaced whole on update, never modified.
+        self.listeners = []  # Called with each new snapshot; see add_listener.
 
-    @property
-    def nodes(self):
-        with self.lock:
-            return self._graph.nodes()
+    # Each of these reads whichever snapshot is current at the time. Readers that need several
+    # values to agree with each other should take graph.snapshot once and use that instead.
+    nodes = _from_snapshot("nodes")
+    edges = _from_snapshot("edges")
+    users = _from_snapshot("users")
+    groups = _from_snapshot("groups")
+    permissions = _from_snapshot("permissions")
+    checkpoint = _from_snapshot("checkpoint")
+    checkpoint_time = _from_snapshot("checkpoint_time")
+    user_metadata = _from_snapshot("user_metadata")
+    group_metadata = _from_snapshot("group_metadata")
+    permission_metadata = _from_snapshot("permission_metadata")
+    permission_tuples = _from_snapshot("permission_tuples")
+    permission_grants = _from_snapshot("permission_grants")
+    directly_audited_groups = _from_snapshot("directly_audited_groups")
+    audited_groups = _from_snapshot("audited_groups")
+    group_tuples = _from_snapshot("group_tuples")
+    disabled_group_tuples = _from_snapshot("disabled_group_tuples")
+    user_closures = _from_snapshot("user_closures")
+    get_changes_since = _from_snapshot("get_changes_since")
+    get_permissions = _from_snapshot("get_permissions")
+    get_permission_details = _from_snapshot("get_permission_details")
+    get_permission_grants = _from_snapshot("get_permission_grants")
+    get_disabled_groups = _from_snapshot("get_disabled_groups")
+    get_groups = _from_snapshot("get_groups")
+    is_group_audited = _from_snapshot("is_group_audited")
+    get_group_details = _from_snapshot("get_group_details")
+    get_user_details = _from_snapshot("get_user_details")
 
-    @property
-    def edges(self):
-        with self.lock:
-            return self._graph.edges()
+    def add_listener(self, callback):
+        """Call callback(snapshot) with each new snapshot right after it's swapped in. It's
+        called on whichever thread did the update, so it should hand off anything slow."""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def _notify_listeners(self, snapshot):
+        for callback in list(self.listeners):
+            try:
+                callback(snapshot)
+            except Exception:
+                self.logger.exception("Graph listener failed.")
 
     @classmethod
-    def from_db(cls, session):
-        inst = cls()
+    def from_db(cls, session, backend="networkx", loader_threads=1):
+        inst = cls(backend=backend, loader_threads=loader_threads)
         inst.update_from_db(session)
         return inst
 
+    def dump_snapshot(self):
+        """Serialize the current snapshot, along with what update_from_db needs to carry on
+        from it, for load_snapshot_data. The result is a list of strings: the user closures,
+        which are most of the data, are split off into chunks so they can be loaded a piece at
+        a time."""
+        with self.update_lock:
+            last_change, snapshot = self.last_change, self.snapshot
+
+        head = copy(snapshot)
+        head.user_closures = {}
+        chunks = [cPickle.dumps(
+            (SNAPSHOT_FORMAT_VERSION, last_change, head), cPickle.HIGHEST_PROTOCOL)]
+
+        closures = snapshot.user_closures.items()
+        for start in xrange(0, len(closures), SNAPSHOT_CHUNK_SIZE):
+            chunk = dict(closures[start:start + SNAPSHOT_CHUNK_SIZE])
+            chunks.append(cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL))
+        return chunks
+
+    def load_snapshot_data(self, chunks):
+        """Start serving a snapshot serialized by dump_snapshot, possibly in another process,
+        and return whether it was usable.
+
+        This runs alongside request handling, so it pauses between chunks to let other threads
+        have the GIL. Garbage collection is held off meanwhile: the new objects are all live, and
+        collecting repeatedly as they pile up would double the time taken."""
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            version, last_change, snapshot = cPickle.loads(chunks[0])
+            if version != SNAPSHOT_FORMAT_VERSION:
+                self.logger.info("Ignoring graph snapshot with format %s", version)
+                return False
+
+            for chunk in chunks[1:]:
+                sleep(0)
+                snapshot.user_closures.update(cPickle.loads(chunk))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        with self.update_lock:
+            self.snapshot = snapshot
+            self.last_change = last_change
+        self._notify_listeners(snapshot)
+        return True
+
+    def save_snapshot(self, path):
+        """Write the current snapshot to path for load_snapshot to start from later. The file
+        is replaced atomically, so concurrent readers and writers never see a partial one."""
+        chunks = self.dump_snapshot()
+        directory = os.path.dirname(os.path.abspath(path))
+        with NamedTemporaryFile(dir=directory, delete=False) as snapshot_file:
+            cPickle.dump(chunks, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(snapshot_file.name, path)
+
+    def load_snapshot(self, path):
+        """Start serving the snapshot saved at path, if there's a usable one, and return whether
+        there was. It's probably stale: the next update_from_db catches up, by applying just the
+        changes since it was saved if the change log still has them."""
+        try:
+            with open(path, "rb") as snapshot_file:
+                loaded = self.load_snapshot_data(cPickle.load(snapshot_file))
+        except IOError as err:
+            self.logger.info("No graph snapshot loaded from %s: %s", path, err)
+            return False
+        except Exception:
+            self.logger.exception("Failed to load graph snapshot from %s", path)
+            return False
+
+        if loaded:
+            self.logger.info("Loaded graph snapshot at checkpoint %d", self.checkpoint)
+            stats.incr("graph-snapshot-load")
+        return loaded
+
     def update_from_db(self, session):
         # Only allow one thread at a time to construct a fresh graph.
         with self.update_lock:
@@ -94,44 +258,462 @@ class GroupGraph(object):
             if checkpoint == self.checkpoint:
                 self.logger.debug("Checkpoint hasn't changed. Not Updating.")
                 return
-            self.logger.debug("Checkpoint changed; updating!")
-
-            new_graph = DiGraph()
-            new_graph.add_nodes_from(self._get_nodes_from_db(session))
-            new_graph.add_edges_from(self._get_edges_from_db(session))
-            rgraph = new_graph.reverse()
-
-            users = set()
-            groups = set()
-            for (node_type, node_name) in new_graph.nodes():
-                if node_type == "User":
-                    users.add(node_name)
-                elif node_type == "Group":
-                    groups.add(node_name)
-
-            user_metadata = self._get_user_metadata(session)
+
+            changes = self._get_changes(session, checkpoint)
+            if changes is None:
+                self.logger.debug("Checkpoint changed; rebuilding!")
+                self._rebuild_from_db(session, checkpoint, checkpoint_time)
+                last_change = GraphChange.get_range(session, checkpoint, checkpoint)
+                last_change = last_change[0] if last_change else None
+                stats.incr("graph-full-update")
+            else:
+                self.logger.debug("Checkpoint changed; applying %d changes.", len(changes) - 1)
+                self._apply_changes_from_db(session, changes[1:], checkpoint, checkpoint_time)
+                last_change = changes[-1]
+                stats.incr("graph-delta-update")
+
+            self.last_change = (last_change.id, last_change.created_on) if last_change else None
+
+    def _get_changes(self, session, checkpoint):
+        """Return the logged changes from our checkpoint up to the given one, led by the change
+        at our own checkpoint, or None if the log can't account for every update in between.
+
+        The leading change must match the one we last applied, which guards against applying
+        deltas from a different database (e.g. after a restore).
+        """
+        if self.snapshot.graph is None or self.last_change is None:
+            return None
+        if not isinstance(self.snapshot.graph, GRAPH_BACKENDS[self.backend]):
+            return None
+        if not (self.checkpoint < checkpoint <= self.checkpoint + MAX_DELTA_CHANGES):
+            return None
+
+        changes = GraphChange.get_range(session, self.checkpoint, checkpoint)
+        if not changes or (changes[0].id, changes[0].created_on) != self.last_change:
+            return None
+        if [change.checkpoint for change in changes] != range(self.checkpoint, checkpoint + 1):
+            return None
+        return changes
+
+    def _rebuild_from_db(self, session, checkpoint, checkpoint_time):
+        loaders = [
+            self._get_nodes_from_db,
+            self._get_edges_from_db,
+            self._get_user_metadata,
+            self._get_permission_metadata,
+            self._get_permission_tuples,
+            self._get_group_tuples,
+            lambda session: self._get_group_tuples(session, enabled=False),
+            self._get_tag_permissions,
+            self._get_user_tokens,
+        ]
+
+        results = None
+        if self.loader_threads > 1:
+            results = self._run_loaders_in_parallel(session, loaders, checkpoint)
+        if results is None:
+            results = [loader(session) for loader in loaders]
+        (nodes, edges, user_metadata, permission_metadata, permission_tuples, group_tuples,
+         disabled_group_tuples, tag_permissions, user_tokens) = results
+
+        new_graph = GRAPH_BACKENDS[self.backend].from_edges(nodes, edges)
+        group_metadata = self._get_group_metadata(session, permission_metadata)
+
+        self._publish(
+            new_graph, checkpoint, checkpoint_time, user_metadata, group_metadata,
+            permission_metadata, permission_tuples, group_tuples, disabled_group_tuples,
+            tag_permissions, user_tokens)
+
+    def _run_loaders_in_parallel(self, session, loaders, checkpoint):
+        """Run each loader on its own session in a pool of loader_threads threads, returning
+        their results in order.
+
+        The loaders' transactions start at slightly different times, so the results are only
+        consistent if nothing was committed while they ran. If the checkpoint moved, returns
+        None and the caller should load sequentially instead.
+        """
+        bind = session.get_bind()
+
+        def get_checkpoint():
+            with closing(Session(bind=bind)) as checkpoint_session:
+                return self._get_checkpoint(checkpoint_session)[0]
+
+        def run(loader):
+            with closing(Session(bind=bind)) as loader_session:
+                return loader(loader_session)
+
+        if get_checkpoint() != checkpoint:
+            return None
+
+        pool = ThreadPool(self.loader_threads)
+        try:
+            results = pool.map(run, loaders)
+        finally:
+            pool.close()
+            pool.join()
+
+        if get_checkpoint() != checkpoint:
+            self.logger.info("Checkpoint moved during a parallel load; loading sequentially.")
+            stats.incr("graph-parallel-load-retry")
+            return None
+        return results
+
+    def _apply_changes_from_db(self, session, changes, checkpoint, checkpoint_time):
+        """Reload only the parts of the graph named by the given changes.
+
+        Every change is applied by re-reading the current state of the object it names, so
+        applying a change twice or out of order is harmless.
+        """
+        node_users = set()  # Users whose node and memberships need reloading.
+        data_users = set()  # Users whose user_metadata entry needs reloading.
+        token_users = set()  # Users whose tokens need reloading.
+        node_groups = set()  # Groups whose node and edges need reloading.
+        tuple_groups = set()  # Groups whose GroupTuple needs reloading.
+        grant_groups = set()  # Groups whose permission grants need reloading.
+        all_grants = False
+        tags_changed = False
+
+        for change in changes:
+            change_type = GraphChangeType(change.change_type)
+            if change_type == GraphChangeType.user:
+                node_users.add(change.name)
+                data_users.add(change.name)
+                token_users.add(change.name)
+                # The service_account flag of a group comes from the user of the same name.
+                tuple_groups.add(change.name)
+            elif change_type == GraphChangeType.group:
+                node_groups.add(change.name)
+                tuple_groups.add(change.name)
+                grant_groups.add(change.name)
+            elif change_type == GraphChangeType.membership:
+                node_groups.add(change.name)
+            elif change_type == GraphChangeType.grant:
+                grant_groups.add(change.name)
+            elif change_type == GraphChangeType.permission:
+                all_grants = True
+            elif change_type == GraphChangeType.tag:
+                tags_changed = True
+            elif change_type == GraphChangeType.user_token:
+                token_users.add(change.name)
+            elif change_type in USER_DATA_CHANGE_TYPES:
+                data_users.add(change.name)
+
+        snapshot = self.snapshot
+        old_graph = snapshot.graph
+        user_metadata = dict(snapshot.user_metadata)
+        group_metadata = dict(snapshot.group_metadata)
+        permission_metadata = defaultdict(list, snapshot.permission_metadata)
+        group_tuples = dict(snapshot.group_tuples)
+        disabled_group_tuples = dict(snapshot.disabled_group_tuples)
+
+        # Drop every node we were told about along with all of its edges, then put back
+        # whatever is still enabled and every active edge that touches it.
+        if node_users or node_groups:
+            dropped = {("User", name) for name in node_users}
+            dropped.update(("Group", name) for name in node_groups)
+            nodes = [node for node in old_graph.nodes() if node not in dropped]
+            nodes.extend(
+                self._get_nodes_from_db(session, usernames=node_users, groupnames=node_groups))
+            edges = [edge for edge in old_graph.edges()
+                     if edge[0] not in dropped and edge[1] not in dropped]
+            edges.extend(
+                self._get_edges_from_db(session, usernames=node_users, groupnames=node_groups))
+            new_graph = GRAPH_BACKENDS[self.backend].from_edges(nodes, edges)
+        else:
+            new_graph = old_graph
+
+        if data_users:
+            for name in data_users:
+                user_metadata.pop(name, None)
+            user_metadata.update(self._get_user_metadata(session, usernames=data_users))
+
+        if tuple_groups:
+            for name in tuple_groups:
+                group_tuples.pop(name, None)
+                disabled_group_tuples.pop(name, None)
+            group_tuples.update(self._get_group_tuples(session, groupnames=tuple_groups))
+            disabled_group_tuples.update(
+                self._get_group_tuples(session, enabled=False, groupnames=tuple_groups))
+
+        if all_grants:
             permission_metadata = self._get_permission_metadata(session)
+        elif grant_groups:
+            for name in grant_groups:
+                permission_metadata.pop(name, None)
+            permission_metadata.update(
+                self._get_permission_metadata(session, groupnames=grant_groups))
+
+        # A group's metadata lists its grants, so it changes along with them.
+        if all_grants:
             group_metadata = self._get_group_metadata(session, permission_metadata)
-            permission_tuples = self._get_permission_tuples(session)
-            group_tuples = self._get_group_tuples(session)
-            disabled_group_tuples = self._get_group_tuples(session, enabled=False)
-
-            with self.lock:
-                self._graph = new_graph
-                self._rgraph = rgraph
-                self.checkpoint = checkpoint
-                self.checkpoint_time = checkpoint_time
-                self.users = users
-                self.groups = groups
-                self.permissions = {perm.permission
-                                    for perm_list in permission_metadata.values()
-                                    for perm in perm_list}
-                self.user_metadata = user_metadata
-                self.group_metadata = group_metadata
-                self.permission_metadata = permission_metadata
-                self.permission_tuples = permission_tuples
-                self.group_tuples = group_tuples
-                self.disabled_group_tuples = disabled_group_tuples
+        elif tuple_groups or grant_groups:
+            metadata_groups = tuple_groups | grant_groups
+            for name in metadata_groups:
+                group_metadata.pop(name, None)
+            group_metadata.update(
+                self._get_group_metadata(session, permission_metadata, groupnames=metadata_groups))
+
+        # Permissions can be created without bumping the counter, and the table is small.
+        permission_tuples = self._get_permission_tuples(session)
+
+        if tags_changed:
+            tag_permissions = self._get_tag_permissions(session)
+        else:
+            tag_permissions = snapshot.tag_permissions
+
+        user_tokens = dict(snapshot.user_tokens)
+        if token_users:
+            for name in token_users:
+                user_tokens.pop(name, None)
+            user_tokens.update(self._get_user_tokens(session, usernames=token_users))
+
+        # Only users at or below a changed group can have gained or lost groups or permissions.
+        if all_grants:
+            stale_users = None
+        else:
+            stale_users = set(node_users)
+            for name in node_groups | grant_groups:
+                for graph in (old_graph, new_graph):
+                    if graph.has_node(("Group", name)):
+                        stale_users.update(
+                            member_name
+                            for member_type, member_name in graph.descendants(("Group", name))
+                            if member_type == "User"
+                        )
+
+        self._publish(
+            new_graph, checkpoint, checkpoint_time, user_metadata, group_metadata,
+            permission_metadata, permission_tuples, group_tuples, disabled_group_tuples,
+            tag_permissions, user_tokens, stale_users=stale_users)
+
+    def _publish(self, new_graph, checkpoint, checkpoint_time, user_metadata, group_metadata,
+                 permission_metadata, permission_tuples, group_tuples, disabled_group_tuples,
+                 tag_permissions, user_tokens, stale_users=None):
+        """Derive the remaining indexes from a freshly loaded graph and swap in a new snapshot.
+        If stale_users is given, only those users' closures are recomputed."""
+        users = set()
+        groups = set()
+        for (node_type, node_name) in new_graph.nodes():
+            if node_type == "User":
+                users.add(node_name)
+            elif node_type == "Group":
+                groups.add(node_name)
+
+        if stale_users is None:
+            user_closures = self._get_user_closures(new_graph, permission_metadata, users)
+        else:
+            user_closures = dict(self.snapshot.user_closures)
+            for name in stale_users:
+                user_closures.pop(name, None)
+            user_closures.update(
+                self._get_user_closures(new_graph, permission_metadata, stale_users & users))
+
+        public_key_permissions = self._get_public_key_permissions(
+            self.snapshot, user_metadata, user_closures, tag_permissions)
+
+        permission_grants = defaultdict(list)
+        for groupname in sorted(permission_metadata):
+            for grant in permission_metadata[groupname]:
+                permission_grants[grant.permission].append(grant)
+
+        # A group is audited if it or any group above it has been granted an audited permission.
+        directly_audited_groups = {
+            groupname for groupname, grants in permission_metadata.iteritems()
+            if any(grant.audited for grant in grants) and groupname in groups
+        }
+        audited_groups = {
+            member_name for member_type, member_name in new_graph.member_closure(
+                [("Group", groupname) for groupname in directly_audited_groups])
+            if member_type == "Group"
+        }
+
+        snapshot = GraphSnapshot(
+            graph=new_graph,
+            checkpoint=checkpoint,
+            checkpoint_time=checkpoint_time,
+            users=users,
+            groups=groups,
+            permissions=set(permission_grants),
+            user_metadata=user_metadata,
+            group_metadata=group_metadata,
+            permission_metadata=permission_metadata,
+            permission_tuples=permission_tuples,
+            permission_grants=dict(permission_grants),
+            directly_audited_groups=frozenset(directly_audited_groups),
+            audited_groups=frozenset(audited_groups),
+            group_tuples=group_tuples,
+            disabled_group_tuples=disabled_group_tuples,
+            user_closures=user_closures,
+            tag_permissions=tag_permissions,
+            public_key_permissions=public_key_permissions,
+            user_tokens=user_tokens,
+        )
+
+        # Readers can't see the new snapshot until it's assigned below, so it's still ours to
+        # fill in. If the checkpoint went backwards, as after a database restore, the history
+        # starts over.
+        old = self.snapshot
+        if old.graph is not None and old.checkpoint < checkpoint:
+            diff = SnapshotDiff(
+                old.checkpoint, checkpoint, *self._get_changed_names(old, snapshot))
+            snapshot.history = old.history[1 - DELTA_HISTORY_SIZE:] + (diff,)
+            snapshot.versions_start = old.versions_start
+            for kind, names in (("users", diff.users), ("groups", diff.groups),
+                                ("permissions", diff.permissions)):
+                versions = dict(old.entity_versions.get(kind, {}))
+                versions.update(dict.fromkeys(names, checkpoint))
+                snapshot.entity_versions[kind] = versions
+        else:
+            snapshot.versions_start = checkpoint
+
+        # A single reference assignment, so readers see either all of the old snapshot or all
+        # of the new one.
+        self.snapshot = snapshot
+        self._notify_listeners(snapshot)
+
+    @staticmethod
+    def _get_changed_names(old, new):
+        """Return sets of the users, groups and permissions whose API output may differ between
+        two snapshots. This errs on the side of including too much, never too little."""
+        def changed(old_dict, new_dict, same=lambda a, b: a == b):
+            return {
+                name for name in set(old_dict) | set(new_dict)
+                if old_dict.get(name) is not new_dict.get(name) and not (
+                    name in old_dict and name in new_dict and same(old_dict[name], new_dict[name]))
+            }
+
+        def same_closure(a, b):
+            # Ordering within a closure depends on how the graph was built, and doesn't matter.
+            return set(a.groups) == set(b.groups) and set(a.permissions) == set(b.permissions)
+
+        users = changed(old.user_metadata, new.user_metadata)
+        users.update(changed(old.user_closures, new.user_closures, same_closure))
+        users.update(changed(old.public_key_permissions, new.public_key_permissions))
+
+        # A group's output covers the members below it and the groups and grants above it.
+        # Changes to its own members show up in both directions, changes to its grants only in
+        # the groups below it, and anything else only in itself.
+        edge_groups = set()
+        if old.graph is not new.graph:
+            old_edges = {(group, member, data["role"]) for group, member, data in old.graph.edges()}
+            new_edges = {(group, member, data["role"]) for group, member, data in new.graph.edges()}
+            for group, member, _ in old_edges ^ new_edges:
+                edge_groups.add(group)
+                if member[0] == "Group":
+                    edge_groups.add(member)
+        grant_groups = {("Group", name) for name in changed(
+            old.permission_metadata, new.permission_metadata,
+            lambda a, b: sorted(a) == sorted(b))}
+        groups = changed(old.group_metadata, new.group_metadata)
+        groups.update(changed(old.group_tuples, new.group_tuples))
+        groups.update(old.groups ^ new.groups)
+
+        for graph in (old.graph, new.graph):
+            reached = {node for node in edge_groups | grant_groups if graph.has_node(node)}
+            below = graph.member_closure(reached)
+            above = set()
+            for node in edge_groups:
+                if graph.has_node(node):
+                    above.update(graph.parent_paths(node))
+            groups.update(name for node_type, name in below | above if node_type == "Group")
+        groups.update(name for _, name in edge_groups | grant_groups)
+
+        # A permission's output covers the details of every group that inherits it.
+        permissions = {
+            permission.name for permission in old.permission_tuples ^ new.permission_tuples}
+        permissions.update(changed(old.permission_grants, new.permission_grants))
+        for snapshot in (old, new):
+            for name in groups:
+                node = ("Group", name)
+                if not snapshot.graph.has_node(node):
+                    continue
+                for (_, ancestor) in snapshot.graph.parent_paths(node):
+                    permissions.update(
+                        grant.permission
+                        for grant in snapshot.permission_metadata.get(ancestor, ()))
+
+        return frozenset(users), frozenset(groups), frozenset(permissions)
+
+    @staticmethod
+    def _get_public_key_permissions(old, user_metadata, user_closures, tag_permissions):
+        """Returns a dict of username: {key id: [KeyPermission]} for users with public keys. A key
+        has its owner's permissions, narrowed down by those allowed to each tag on the key.
+
+        A user's entry is carried over from the old snapshot if their metadata, closure and the
+        tag permissions are all the same objects as it was computed from."""
+        # TODO: Fix circular dependency
+        from grouper.permissions import permission_intersection
+
+        reuse = old.tag_permissions is tag_permissions
+        out = {}
+        for username, md in user_metadata.iteritems():
+            if not md["public_keys"]:
+                continue
+            closure = user_closures.get(username)
+            if (reuse and username in old.public_key_permissions and
+                    old.user_metadata.get(username) is md and
+                    old.user_closures.get(username) is closure):
+                out[username] = old.public_key_permissions[username]
+                continue
+
+            # Disabled users have no closure, and their keys no permissions.
+            user_permissions = {
+                KeyPermission(permission.permission, permission.argument)
+                for permission in (closure.permissions if closure else ())
+            }
+            out[username] = keys = {}
+            for key in md["public_keys"]:
+                key_permissions = user_permissions
+                for tag in key["tags"]:
+                    key_permissions = permission_intersection(
+                        key_permissions, tag_permissions.get(tag, ()))
+                keys[key["id"]] = sorted(key_permissions)
+        return out
+
+    @staticmethod
+    def _get_user_closures(graph, permission_metadata, usernames):
+        '''
+        Returns a dict of username: UserClosure for the given enabled users.
+
+        User permissions are inherited from all groups for which their role is not "np-owner".
+        User groups are all groups in which a user is a member by inheritance, except for
+        ancestors of groups where their role is "np-owner", unless the user is a member of such
+        an ancestor via a non-"np-owner" role in another group.
+        '''
+        ancestors = {}  # group -> {ancestor: path}, shared by every member of the group.
+        out = {}
+        for username in usernames:
+            user = ("User", username)
+            groups = {}
+            rpaths = {}
+            for group, role in graph.parents(user):
+                if GROUP_EDGE_ROLES[role] == "np-owner":
+                    groups[group[1]] = UserGroup(group[1], (username, group[1]), 1, role)
+                    continue
+                if group not in ancestors:
+                    ancestors[group] = graph.parent_paths(group)
+                for parent, path in ancestors[group].iteritems():
+                    if parent not in rpaths or 1 + len(path) < len(rpaths[parent]):
+                        rpaths[parent] = [user] + path
+
+            permissions = []
+            for parent, path in rpaths.iteritems():
+                parent_name = parent[1]
+                names = tuple(elem[1] for elem in path)
+                distance = len(path) - 1
+                role = graph.role(parent, path[-2])
+                groups[parent_name] = UserGroup(parent_name, names, distance, role)
+                for permission in permission_metadata.get(parent_name, []):
+                    permissions.append(UserPermission(
+                        permission=permission.permission,
+                        argument=permission.argument,
+                        granted_on=(permission.granted_on - EPOCH).total_seconds(),
+                        path=names,
+                        distance=distance,
+                    ))
+
+            out[username] = UserClosure(tuple(groups.itervalues()), tuple(permissions))
+        return out
 
     @staticmethod
     def _get_checkpoint(session):
@@ -141,161 +723,259 @@ class GroupGraph(object):
         return counter.count, int(counter.last_modified.strftime("%s"))
 
     @staticmethod
-    def _get_user_metadata(session):
+    def _get_user_metadata(session, usernames=None):
         '''
-        Returns a dict of username: { dict of metadata }.
+        Returns a dict of username: { dict of metadata }. If usernames is given, only those
+        users are loaded.
         '''
+        users = session.query(User.id, User.username, User.enabled, User.role_user)
+        if usernames is not None:
+            users = users.filter(User.username.in_(usernames)).all()
+            user_ids = [user.id for user in users]
+            if not user_ids:
+                return {}
+        else:
+            users = users.yield_per(LOADER_BATCH_SIZE)
 
-        def user_indexify(data):
-            ret = defaultdict(list)
-            for item in data:
-                ret[item.user_id].append(item)
-            return ret
-
-        users = session.query(User)
-
-        passwords = user_indexify(session.query(UserPassword).all())
-        public_keys = user_indexify(session.query(PublicKey).all())
-        user_metadata = user_indexify(session.query(UserMetadata).all())
-        public_key_tags = get_all_public_key_tags(session)
+        def user_rows(user_id_column, *columns):
+            query = session.query(user_id_column, *columns)
+            if usernames is not None:
+                query = query.filter(user_id_column.in_(user_ids))
+            return query.yield_per(LOADER_BATCH_SIZE)
 
         out = {}
-        for user in users:
-            out[user.username] = {
-                "enabled": user.enabled,
-                "role_user": user.role_user,
-                "passwords": [
-                    {
-                         "name": password.name,
-                         "hash": password.password_hash,
-                         "salt": password.salt,
-                         "func": "crypt(3)-$6$",
-                    } for password in passwords.get(user.id, [])
-                ],
-                "public_keys": [
-                    {
-                        "public_key": key.public_key,
-                        "fingerprint": key.fingerprint,
-                        "created_on": str(key.created_on),
-                        "tags": [tag.name for tag in public_key_tags.get(key.id, [])],
-                        "id": key.id,
-                    } for key in public_keys.get(user.id, [])
-                ],
-                "metadata": [
-                    {
-                        "data_key": row.data_key,
-                        "data_value": row.data_value,
-                        "last_modified": str(row.last_modified),
-                    } for row in user_metadata.get(user.id, [])
-                ],
+        by_id = {}
+        for user_id, username, enabled, role_user in users:
+            out[username] = by_id[user_id] = {
+                "enabled": enabled,
+                "role_user": role_user,
+                "passwords": [],
+                "public_keys": [],
+                "metadata": [],
             }
+
+        for user_id, name, password_hash, salt in user_rows(
+                UserPassword.user_id, UserPassword.name, UserPassword._hashed_secret,
+                UserPassword.salt):
+            by_id[user_id]["passwords"].append({
+                "name": name,
+                "hash": password_hash,
+                "salt": salt,
+                "func": "crypt(3)-$6$",
+            })
+
+        public_key_tags = defaultdict(list)
+        for _, key_id, tag_name in user_rows(
+                PublicKey.user_id, PublicKeyTagMap.key_id, PublicKeyTag.name).filter(
+                PublicKey.id == PublicKeyTagMap.key_id,
+                PublicKeyTag.id == PublicKeyTagMap.tag_id):
+            public_key_tags[key_id].append(tag_name)
+
+        for user_id, key_id, public_key, fingerprint, created_on in user_rows(
+                PublicKey.user_id, PublicKey.id, PublicKey.public_key, PublicKey.fingerprint,
+                PublicKey.created_on):
+            by_id[user_id]["public_keys"].append({
+                "public_key": public_key,
+                "fingerprint": fingerprint,
+                "created_on": str(created_on),
+                "tags": public_key_tags.get(key_id, []),
+                "id": key_id,
+            })
+
+        for user_id, data_key, data_value, last_modified in user_rows(
+                UserMetadata.user_id, UserMetadata.data_key, UserMetadata.data_value,
+                UserMetadata.last_modified):
+            by_id[user_id]["metadata"].append({
+                "data_key": data_key,
+                "data_value": data_value,
+                "last_modified": str(last_modified),
+            })
+
         return out
 
     # This describes how permissions are assigned to groups, NOT the intrinsic
     # metadata for a permission.
     @staticmethod
-    def _get_permission_metadata(session):
+    def _get_permission_metadata(session, groupnames=None):
         '''
-        Returns a dict of groupname: { list of permissions }.
+        Returns a dict of groupname: { list of permissions }. If groupnames is given, only
+        grants to those groups are loaded.
         '''
         out = defaultdict(list)  # groupid -> [ ... ]
-        permissions = session.query(Permission, PermissionMap).filter(
+        permissions = session.query(
+            Permission.name,
+            Permission._audited,
+            PermissionMap.argument,
+            PermissionMap.granted_on,
+            Group.groupname,
+        ).filter(
             Permission.id == PermissionMap.permission_id,
             PermissionMap.group_id == Group.id,
             Group.enabled == True,
         )
-        for permission in permissions:
-            out[permission[1].group.name].append(MappedPermission(
-                permission=permission[0].name,
-                audited=permission[0].audited,
-                argument=permission[1].argument,
-                groupname=permission[1].group.name,
-                granted_on=permission[1].granted_on,
+        if groupnames is not None:
+            permissions = permissions.filter(Group.groupname.in_(groupnames))
+        for name, audited, argument, granted_on, groupname in permissions.yield_per(
+                LOADER_BATCH_SIZE):
+            out[groupname].append(MappedPermission(
+                permission=name,
+                audited=audited,
+                argument=argument,
+                groupname=groupname,
+                granted_on=granted_on,
             ))
         return out
 
+    @staticmethod
+    def _get_tag_permissions(session):
+        """Returns a dict of tag name: [KeyPermission] allowed to keys with that tag."""
+        out = defaultdict(list)
+        tag_permissions = session.query(
+            PublicKeyTag.name,
+            Permission.name,
+            TagPermissionMap.argument,
+        ).filter(
+            PublicKeyTag.id == TagPermissionMap.tag_id,
+            Permission.id == TagPermissionMap.permission_id,
+        )
+        for tag_name, name, argument in tag_permissions.yield_per(LOADER_BATCH_SIZE):
+            out[tag_name].append(KeyPermission(name, argument))
+        return dict(out)
+
+    @staticmethod
+    def _get_user_tokens(session, usernames=None):
+        """Returns a dict of username: {token name: TokenTuple}. If usernames is given, only
+        tokens of those users are loaded."""
+        out = defaultdict(dict)
+        tokens = session.query(
+            User.username,
+            User.enabled,
+            UserToken.name,
+            UserToken.hashed_secret,
+            UserToken.disabled_at,
+        ).filter(
+            User.id == UserToken.user_id,
+        )
+        if usernames is not None:
+            tokens = tokens.filter(User.username.in_(usernames))
+        for username, user_enabled, name, hashed_secret, disabled_at in tokens.yield_per(
+                LOADER_BATCH_SIZE):
+            out[username][name] = TokenTuple(
+                hashed_secret=hashed_secret,
+                enabled=bool(user_enabled) and disabled_at is None,
+            )
+        return dict(out)
+
     @staticmethod
     def _get_permission_tuples(session):
         '''
         Returns a set of PermissionTuple instances.
         '''
-        out = set()
-        permissions = (
-            session.query(Permission)
-            .order_by(Permission.name)
+        permissions = session.query(
+            Permission.id,
+            Permission.name,
+            Permission.description,
+            Permission.created_on,
+            Permission._audited,
         )
-        for permission in permissions:
-            out.add(PermissionTuple(
-                id=permission.id,
-                name=permission.name,
-                description=permission.description,
-                created_on=permission.created_on,
-                audited=permission._audited,
-            ))
-        return out
+        return {PermissionTuple(*row) for row in permissions.yield_per(LOADER_BATCH_SIZE)}
 
     @staticmethod
-    def _get_group_metadata(session, permission_metadata):
+    def _get_group_metadata(session, permission_metadata, groupnames=None):
         '''
-        Returns a dict of groupname: { dict of metadata }.
+        Returns a dict of groupname: { dict of metadata }. If groupnames is given, only those
+        groups are loaded.
         '''
-        groups = session.query(Group).filter(
+        groups = session.query(Group.groupname).filter(
             Group.enabled == True
         )
+        if groupnames is not None:
+            groups = groups.filter(Group.groupname.in_(groupnames))
 
         out = {}
-        for group in groups:
-            out[group.groupname] = {
+        for groupname, in groups.yield_per(LOADER_BATCH_SIZE):
+            out[groupname] = {
                 "permissions": [
                     {
                         "permission": permission.permission,
                         "argument": permission.argument,
-                    } for permission in permission_metadata[group.id]
+                    } for permission in permission_metadata.get(groupname, [])
                 ],
             }
         return out
 
     @staticmethod
-    def _get_group_tuples(session, enabled=True):
+    def _get_group_tuples(session, enabled=True, groupnames=None):
         '''
-        Returns a dict of groupname: GroupTuple.
+        Returns a dict of groupname: GroupTuple. If groupnames is given, only those groups are
+        loaded.
         '''
         out = {}
-        groups = (
-            session.query(Group)
-            .order_by(Group.groupname)
+        # A group is part of a service account if there's a role user with the same name.
+        groups = session.query(
+            Group.id,
+            Group.groupname,
+            Group.description,
+            Group.canjoin,
+            Group.enabled,
+            User.role_user,
+        ).outerjoin(
+            User, User.username == Group.groupname
         ).filter(
             Group.enabled == enabled
         )
-        for group in groups:
-            out[group.groupname] = GroupTuple(
-                id=group.id,
-                groupname=group.groupname,
-                name=group.groupname,
-                description=group.description,
-                canjoin=group.canjoin,
-                enabled=group.enabled,
-                service_account=is_service_account(session, group=group),
+        if groupnames is not None:
+            groups = groups.filter(Group.groupname.in_(groupnames))
+        for group_id, groupname, description, canjoin, group_enabled, role_user in (
+                groups.yield_per(LOADER_BATCH_SIZE)):
+            out[groupname] = GroupTuple(
+                id=group_id,
+                groupname=groupname,
+                name=groupname,
+                description=description,
+                canjoin=canjoin,
+                enabled=group_enabled,
+                service_account=bool(role_user),
                 type="Group"
             )
         return out
 
     @staticmethod
-    def _get_nodes_from_db(session):
-        return session.query(
+    def _get_nodes_from_db(session, usernames=None, groupnames=None):
+        '''
+        Returns the enabled users and groups as (type, name) tuples. If either usernames or
+        groupnames is given, only the named users and groups are returned.
+        '''
+        user_query = session.query(
             label("type", literal("User")),
             label("name", User.username)
         ).filter(
             User.enabled == True
-        ).union(session.query(
+        )
+        group_query = session.query(
             label("type", literal("Group")),
             label("name", Group.groupname)
         ).filter(
             Group.enabled == True
-        )).all()
+        )
+
+        if usernames is None and groupnames is None:
+            return user_query.union(group_query).all()
+
+        nodes = []
+        if usernames:
+            nodes.extend(user_query.filter(User.username.in_(usernames)).all())
+        if groupnames:
+            nodes.extend(group_query.filter(Group.groupname.in_(groupnames)).all())
+        return nodes
 
     @staticmethod
-    def _get_edges_from_db(session):
+    def _get_edges_from_db(session, usernames=None, groupnames=None):
+        '''
+        Returns the active edges as (parent, member, attributes) tuples. If either usernames or
+        groupnames is given, only the edges into or out of the named users and groups are
+        returned.
+        '''
 
         parent = aliased(Group)
         group_member = aliased(Group)
@@ -304,7 +984,7 @@ class GroupGraph(object):
 
         now = datetime.utcnow()
 
-        query = session.query(
+        group_query = session.query(
             label("groupname", parent.groupname),
             label("type", literal("Group")),
             label("name", group_member.groupname),
@@ -320,7 +1000,8 @@ class GroupGraph(object):
                 GroupEdge.expiration == None
             ),
             GroupEdge.member_type == 1
-        ).union(session.query(
+        )
+        user_query = session.query(
             label("groupname", parent.groupname),
             label("type", literal("User")),
             label("name", user_member.username),
@@ -336,9 +1017,26 @@ class GroupGraph(object):
                 GroupEdge.expiration == None
             ),
             GroupEdge.member_type == 0
-        ))
+        )
+
+        if usernames is None and groupnames is None:
+            records = group_query.union(user_query).all()
+        else:
+            records = []
+            if groupnames:
+                records.extend(group_query.filter(or_(
+                    parent.groupname.in_(groupnames),
+                    group_member.groupname.in_(groupnames),
+                )).all())
+            if groupnames or usernames:
+                clauses = []
+                if groupnames:
+                    clauses.append(parent.groupname.in_(groupnames))
+                if usernames:
+                    clauses.append(user_member.username.in_(usernames))
+                records.extend(user_query.filter(or_(*clauses)).all())
 
-        for record in query.all():
+        for record in records:
             edges.append((
                 ("Group", record.groupname),
                 (record.type, record.name),
@@ -347,143 +1045,206 @@ class GroupGraph(object):
 
         return edges
 
+
+class GraphSnapshot(object):
+    """The graph and everything derived from it at a single checkpoint.
+
+    Snapshots are never modified once built, so any number of readers can use one without
+    locking, and everything read from one snapshot is consistent with its checkpoint.
+    """
+
+    def __init__(self, graph=None, checkpoint=0, checkpoint_time=0, users=frozenset(),
+                 groups=frozenset(), permissions=frozenset(), user_metadata=None,
+                 group_metadata=None, permission_metadata=None, permission_tuples=frozenset(),
+                 permission_grants=None, directly_audited_groups=frozenset(),
+                 audited_groups=frozenset(), group_tuples=None, disabled_group_tuples=None,
+                 user_closures=None, tag_permissions=None, public_key_permissions=None,
+                 user_tokens=None, history=(), versions_start=0, entity_versions=None):
+        self.graph = graph  # One of GRAPH_BACKENDS.
+        self.checkpoint = checkpoint
+        self.checkpoint_time = checkpoint_time
+        self.users = users  # Enabled user names.
+        self.groups = groups  # Group names.
+        self.permissions = permissions  # Permission names.
+        self.user_metadata = user_metadata or {}  # username -> {metaddata:[{}] public_keys:[{}]}.
+        self.group_metadata = group_metadata or {}
+        # TODO: rename.  This is about permission grants.
+        self.permission_metadata = permission_metadata or {}
+        self.permission_tuples = permission_tuples  # Mock Permission instances.
+        # permission name -> [MappedPermission], the direct grants ordered by groupname.
+        self.permission_grants = permission_grants or {}
+        self.directly_audited_groups = directly_audited_groups  # Granted an audited permission.
+        self.audited_groups = audited_groups  # At or below a directly audited group.
+        self.group_tuples = group_tuples or {}  # groupname -> Mock Group instance.
+        self.disabled_group_tuples = disabled_group_tuples or {}  # groupname -> Mock Group.
+        self.user_closures = user_closures or {}  # username -> UserClosure, for enabled users.
+        self.tag_permissions = tag_permissions or {}  # tag name -> [KeyPermission].
+        # username -> {public key id: [KeyPermission]}, for users with keys.
+        self.public_key_permissions = public_key_permissions or {}
+        self.user_tokens = user_tokens or {}  # username -> {token name: TokenTuple}.
+        # SnapshotDiff tuples for up to DELTA_HISTORY_SIZE refreshes, oldest first, ending here.
+        self.history = history
+        # "users"/"groups"/"permissions" -> {name: the checkpoint at which its API output last
+        # changed}, for those that changed after versions_start; see get_version.
+        self.versions_start = versions_start
+        self.entity_versions = entity_versions or {}
+
+        # Results of the get_*_details queries. Since the snapshot never changes they stay
+        # valid for its lifetime, and are dropped along with it when a new one is swapped in.
+        # Callers share the cached dicts, so they must not modify them.
+        self._details_cache = LRUCache("graph-details", DETAILS_CACHE_SIZE)
+
+    def __getstate__(self):
+        # The cache holds a lock and refills quickly, so it isn't saved.
+        state = dict(self.__dict__)
+        del state["_details_cache"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._details_cache = LRUCache("graph-details", DETAILS_CACHE_SIZE)
+
+    @property
+    def nodes(self):
+        return self.graph.nodes()
+
+    @property
+    def edges(self):
+        return [(parent, member) for parent, member, _ in self.graph.edges()]
+
+    def get_changes_since(self, checkpoint):
+        """Return a SnapshotDiff from the given checkpoint to this snapshot's, or None if the
+        history doesn't go back that far and the caller has to start over."""
+        if checkpoint == self.checkpoint:
+            return SnapshotDiff(checkpoint, checkpoint, frozenset(), frozenset(), frozenset())
+        if checkpoint > self.checkpoint or not self.history or checkpoint < self.history[0].start:
+            return None
+
+        users, groups, permissions = set(), set(), set()
+        for diff in self.history:
+            if diff.end > checkpoint:
+                users.update(diff.users)
+                groups.update(diff.groups)
+                permissions.update(diff.permissions)
+        return SnapshotDiff(checkpoint, self.checkpoint, users, groups, permissions)
+
+    def get_version(self, kind, name):
+        """Return a checkpoint whose snapshot gave the same API output for the named user, group
+        or permission ("users", "groups" or "permissions") as this one does."""
+        return self.entity_versions.get(kind, {}).get(name, self.versions_start)
+
     def get_permissions(self, audited=False):
         """ Get the list of permissions as PermissionTuple instances sorted by name. """
-        with self.lock:
-            permissions = sorted(self.permission_tuples, key=lambda p: p.name)
+        permissions = sorted(self.permission_tuples, key=lambda p: p.name)
         if audited:
             permissions = filter(lambda p: p.audited, permissions)
         return permissions
 
-    def get_permission_details(self, name):
-        """ Get a permission and what groups it's assigned to. """
+    def get_permission_details(self, name, cached=True):
+        """ Get a permission and what groups it's assigned to. With cached=False the
+        details are worked out afresh and not added to the cache, as for one-off walks over
+        every entity that would otherwise push out what other readers keep coming back for. """
+        if not cached:
+            return self._get_permission_details(name, cached=False)
+        return self._details_cache.get_or_set(
+            ("permission", name, None, None, self.checkpoint),
+            lambda: self._get_permission_details(name))
 
-        with self.lock:
-            data = {
-                "groups": {},
-            }
+    def _get_permission_details(self, name, cached=True):
+        # Every group at or below a group granted the permission inherits it, so find them all
+        # with one walk down from all of the grants.
+        granted = {("Group", grant.groupname) for grant in self.permission_grants.get(name, [])}
+        inheriting = self.graph.member_closure(
+            [group for group in granted if self.graph.has_node(group)])
 
-            # Get all mapped versions of the permission. This is only direct relationships.
-            direct_groups = set()
-            for groupname, permissions in self.permission_metadata.iteritems():
-                for permission in permissions:
-                    if permission.permission == name:
-                        data["groups"][groupname] = self.get_group_details(
-                            groupname, show_permission=name)
-                        direct_groups.add(groupname)
-
-            # Now find all members of these groups going down the tree.
-            checked_groups = set()
-            for groupname in direct_groups:
-                group = ("Group", groupname)
-                paths = single_source_shortest_path(self._graph, group, None)
-                for member, path in paths.iteritems():
-                    if member == group:
-                        continue
-                    member_type, member_name = member
-                    if member_type != 'Group':
-                        continue
-                    if member_name in checked_groups:
-                        continue
-                    checked_groups.add(member_name)
-                    data["groups"][member_name] = self.get_group_details(
-                        member_name, show_permission=name)
-
-            return data
+        return {
+            "groups": {
+                member_name: self.get_group_details(
+                    member_name, show_permission=name, cached=cached)
+                for member_type, member_name in inheriting
+                if member_type == "Group"
+            },
+        }
+
+    def get_permission_grants(self, name):
+        """ Get the direct grants of a permission as MappedPermission instances sorted by
+        groupname. """
+        return self.permission_grants.get(name, [])
 
     def get_disabled_groups(self):
         """ Get the list of disabled groups as GroupTuple instances sorted by groupname. """
-        with self.lock:
-            return sorted(self.disabled_group_tuples.values(), key=lambda g: g.groupname)
+        return sorted(self.disabled_group_tuples.values(), key=lambda g: g.groupname)
 
     def get_groups(self, audited=False, directly_audited=False):
         """ Get the list of groups as GroupTuple instances sorted by groupname. """
+        groups = sorted(self.group_tuples.values(), key=lambda g: g.groupname)
         if directly_audited:
-            audited = True
-        with self.lock:
-            groups = sorted(self.group_tuples.values(), key=lambda g: g.groupname)
-            if audited:
-                def is_directly_audited(group):
-                    for mp in self.permission_metadata[group.groupname]:
-                        if mp.audited:
-                            return True
-                    return False
-                directly_audited_groups = filter(is_directly_audited, groups)
-                if directly_audited:
-                    return directly_audited_groups
-                queue = [("Group", group.groupname) for group in directly_audited_groups]
-                audited_group_nodes = set()
-                while len(queue):
-                    g = queue.pop()
-                    if g not in audited_group_nodes:
-                        audited_group_nodes.add(g)
-                        for nhbr in self._graph.neighbors(g):  # Members of g.
-                            if nhbr[0] == 'Group':
-                                queue.append(nhbr)
-                groups = sorted([self.group_tuples[group[1]] for group in audited_group_nodes],
-                                key=lambda g: g.groupname)
+            return [group for group in groups if group.groupname in self.directly_audited_groups]
+        if audited:
+            return [group for group in groups if group.groupname in self.audited_groups]
         return groups
 
-    def get_group_details(self, groupname, cutoff=None, show_permission=None):
+    def is_group_audited(self, groupname):
+        """ Whether a group is audited, as in get_group_details. Raise NoSuchGroup for missing
+        groups. """
+        if groupname not in self.groups:
+            raise NoSuchGroup("Group %s is either missing or disabled." % groupname)
+        return groupname in self.audited_groups
+
+    def get_group_details(self, groupname, cutoff=None, show_permission=None, cached=True):
         """ Get users and permissions that belong to a group. Raise NoSuchGroup
-        for missing groups. """
-
-        with self.lock:
-            # This is calculated based on all the permissions that apply to this group. Since this
-            # is a graph walk, we calculate it here when we're getting this data.
-            group_audited = False
-            data = {
-                "users": {},
-                "groups": {},
-                "subgroups": {},
-                "permissions": [],
-                "audited": group_audited,
-            }
+        for missing groups. cached is as for get_permission_details. """
+        if not cached:
+            return self._get_group_details(groupname, cutoff, show_permission)
+        return self._details_cache.get_or_set(
+            ("group", groupname, cutoff, show_permission, self.checkpoint),
+            lambda: self._get_group_details(groupname, cutoff, show_permission))
 
-            group = ("Group", groupname)
-            if not self._graph.has_node(group):
-                raise NoSuchGroup("Group %s is either missing or disabled." % groupname)
-            paths = single_source_shortest_path(self._graph, group, cutoff)
-            rpaths = single_source_shortest_path(self._rgraph, group, cutoff)
+    def _get_group_details(self, groupname, cutoff, show_permission):
 
-            for member, path in paths.iteritems():
-                if member == group:
-                    continue
-                member_type, member_name = member
-                role = self._graph[group][path[1]]["role"]
-                data[MEMBER_TYPE_MAP[member_type]][member_name] = {
-                    "name": member_name,
-                    "path": [elem[1] for elem in path],
-                    "distance": len(path) - 1,
-                    "role": role,
-                    "rolename": GROUP_EDGE_ROLES[role],
-                }
+        # This is calculated based on all the permissions that apply to this group. Since this
+        # is a graph walk, we calculate it here when we're getting this data.
+        group_audited = False
+        data = {
+            "users": {},
+            "groups": {},
+            "subgroups": {},
+            "permissions": [],
+            "audited": group_audited,
+        }
 
-            for parent, path in rpaths.iteritems():
-                if parent == group:
-                    continue
-                parent_type, parent_name = parent
-                role = self._rgraph[path[-2]][parent]["role"]
-                data["groups"][parent_name] = {
-                    "name": parent_name,
-                    "path": [elem[1] for elem in path],
-                    "distance": len(path) - 1,
-                    "role": role,
-                    "rolename": GROUP_EDGE_ROLES[role],
-                }
-                for permission in self.permission_metadata.get(parent_name, []):
-                    if show_permission is not None and permission.permission != show_permission:
-                        continue
-                    if permission.audited:
-                        group_audited = True
-                    data["permissions"].append({
-                        "permission": permission.permission,
-                        "argument": permission.argument,
-                        "granted_on": (permission.granted_on - EPOCH).total_seconds(),
-                        "distance": len(path) - 1,
-                        "path": [elem[1] for elem in path],
-                    })
-            for permission in self.permission_metadata.get(groupname, []):
+        group = ("Group", groupname)
+        if not self.graph.has_node(group):
+            raise NoSuchGroup("Group %s is either missing or disabled." % groupname)
+        paths = self.graph.member_paths(group, cutoff)
+        rpaths = self.graph.parent_paths(group, cutoff)
+
+        for member, path in paths.iteritems():
+            if member == group:
+                continue
+            member_type, member_name = member
+            role = self.graph.role(group, path[1])
+            data[MEMBER_TYPE_MAP[member_type]][member_name] = {
+                "name": member_name,
+                "path": [elem[1] for elem in path],
+                "distance": len(path) - 1,
+                "role": role,
+                "rolename": GROUP_EDGE_ROLES[role],
+            }
+
+        for parent, path in rpaths.iteritems():
+            if parent == group:
+                continue
+            parent_type, parent_name = parent
+            role = self.graph.role(parent, path[-2])
+            data["groups"][parent_name] = {
+                "name": parent_name,
+                "path": [elem[1] for elem in path],
+                "distance": len(path) - 1,
+                "role": role,
+                "rolename": GROUP_EDGE_ROLES[role],
+            }
+            for permission in self.permission_metadata.get(parent_name, []):
                 if show_permission is not None and permission.permission != show_permission:
                     continue
                 if permission.audited:
@@ -492,16 +1253,37 @@ class GroupGraph(object):
                     "permission": permission.permission,
                     "argument": permission.argument,
                     "granted_on": (permission.granted_on - EPOCH).total_seconds(),
-                    "distance": 0,
-                    "path": [groupname],
+                    "distance": len(path) - 1,
+                    "path": [elem[1] for elem in path],
                 })
+        for permission in self.permission_metadata.get(groupname, []):
+            if show_permission is not None and permission.permission != show_permission:
+                continue
+            if permission.audited:
+                group_audited = True
+            data["permissions"].append({
+                "permission": permission.permission,
+                "argument": permission.argument,
+                "granted_on": (permission.granted_on - EPOCH).total_seconds(),
+                "distance": 0,
+                "path": [groupname],
+            })
 
-            data["audited"] = group_audited
-            return data
+        data["audited"] = group_audited
+        return data
 
-    def get_user_details(self, username, cutoff=None):
-        """ Get a user's groups and permissions.  Raise NoSuchUser for missing users."""
-        max_dist = cutoff - 1 if (cutoff is not None) else None
+    def get_user_details(self, username, cutoff=None, cached=True):
+        """ Get a user's groups and permissions.  Raise NoSuchUser for missing users.
+        cached is as for get_permission_details. """
+        if not cached:
+            return self._get_user_details(username, cutoff)
+        return self._details_cache.get_or_set(
+            ("user", username, cutoff, None, self.checkpoint),
+            lambda: self._get_user_details(username, cutoff))
+
+    def _get_user_details(self, username, cutoff):
+        # A user's direct groups are always included, whatever the cutoff.
+        max_dist = max(cutoff, 1) if (cutoff is not None) else None
 
         groups = {}
         permissions = []
@@ -510,60 +1292,35 @@ class GroupGraph(object):
             "permissions": permissions,
         }
 
-        with self.lock:
-            if username not in self.user_metadata:
-                raise NoSuchUser(username)
-
-            user = ("User", username)
-
-            # For disabled users or users introduced between SQL queries, just
-            # return empty details.
-            if not self._rgraph.has_node(user):
-                return user_details
+        if username not in self.user_metadata:
+            raise NoSuchUser(username)
+        closure = self.user_closures.get(username)
 
-            # User permissions are inherited from all groups for which their
-            # role is not "np-owner".  User groups are all groups in which a
-            # user is a member by inheritance, except for ancestors of groups
-            # where their role is "np-owner", unless the user is a member of
-            # such an ancestor via a non-"np-owner" role in another group.
-            rpaths = {}
-            for group in self._rgraph.neighbors(user):
-                role = self._rgraph[user][group]["role"]
-                if GROUP_EDGE_ROLES[role] == "np-owner":
-                    group_name = group[1]
-                    groups[group_name] = {
-                        "name": group_name,
-                        "path": [username, group_name],
-                        "distance": 1,
-                        "role": role,
-                        "rolename": GROUP_EDGE_ROLES[role],
-                    }
-                    continue
-                new_rpaths = single_source_shortest_path(self._rgraph, group, max_dist)
-                for parent, path in new_rpaths.iteritems():
-                    if parent not in rpaths or 1 + len(path) < len(rpaths[parent]):
-                        rpaths[parent] = [user] + path
+        # For disabled users or users introduced between SQL queries, just
+        # return empty details.
+        if closure is None:
+            return user_details
 
-            for parent, path in rpaths.iteritems():
-                if parent == user:
-                    continue
-                parent_type, parent_name = parent
-                role = self._rgraph[path[-2]][parent]["role"]
-                groups[parent_name] = {
-                    "name": parent_name,
-                    "path": [elem[1] for elem in path],
-                    "distance": len(path) - 1,
-                    "role": role,
-                    "rolename": GROUP_EDGE_ROLES[role],
-                }
+        for group in closure.groups:
+            if max_dist is not None and group.distance > max_dist:
+                continue
+            groups[group.name] = {
+                "name": group.name,
+                "path": list(group.path),
+                "distance": group.distance,
+                "role": group.role,
+                "rolename": GROUP_EDGE_ROLES[group.role],
+            }
 
-                for permission in self.permission_metadata[parent_name]:
-                    permissions.append({
-                        "permission": permission.permission,
-                        "argument": permission.argument,
-                        "granted_on": (permission.granted_on - EPOCH).total_seconds(),
-                        "path": [elem[1] for elem in path],
-                        "distance": len(path) - 1,
-                    })
+        for permission in closure.permissions:
+            if max_dist is not None and permission.distance > max_dist:
+                continue
+            permissions.append({
+                "permission": permission.permission,
+                "argument": permission.argument,
+                "granted_on": permission.granted_on,
+                "path": list(permission.path),
+                "distance": permission.distance,
+            })
 
-            return user_details
+        return user_details
@@ -1,4 +1,4 @@
-from grouper.graph import Graph, NoSuchGroup
+from grouper.graph import Graph
 from grouper.model_soup import Group
 from grouper.models.base.session import Session  # noqa
 
@@ -31,17 +31,7 @@ def get_audited_groups(session):
     Returns:
         a list of all enabled and audited Group objects in the database
     """
-    audited_groups = []
-    graph = Graph()
-    for group in get_all_groups(session):
-        try:
-            group_md = graph.get_group_details(group.name)
-        except NoSuchGroup:
-            # Very new group with no metadata yet, or it has been disabled and
-            # excluded from in-memory cache.
-            continue
-
-        if group_md.get('audited', False):
-            audited_groups.append(group)
-
-    return audited_groups
+    # Very new groups with no metadata yet, and disabled groups, are not in the in-memory cache
+    # and so are not included.
+    audited_groups = Graph().audited_groups
+    return [group for group in get_all_groups(session) if group.name in audited_groups]
@@ -1,18 +1,21 @@
 from expvar.stats import stats
 from tornado.web import RequestHandler
 
+from grouper.query_stats import get_slowest_queries
+
 
 # this guys shouldn't count as requests so we use tornado's RequestHandler
 class Stats(RequestHandler):
     def get(self):
-        """Returns all gathered stats. This includes a 'mimic_head' query
-        parameter which lets process management/monitoring without support for
-        HEAD queries to use this endpoint for health checks."""
+        """Returns all gathered stats, along with the slowest SQL statements
+        seen for each handler. This includes a 'mimic_head' query parameter
+        which lets process management/monitoring without support for HEAD
+        queries to use this endpoint for health checks."""
         mimic_head = self.get_argument("mimic_head", False)
         if mimic_head:
             return self.head()
         else:
-            return self.write(stats.to_dict())
+            return self.write(dict(stats.to_dict(), slowest_queries=get_slowest_queries()))
 
     def head(self):
         """Support process management/monitoring of health checks with stat
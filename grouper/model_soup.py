@@ -24,7 +24,7 @@ from grouper.models.base.constants import OBJ_TYPES_IDX, REQUEST_STATUS_CHOICES
 from grouper.models.base.model_base import Model
 from grouper.models.base.session import flush_transaction
 from grouper.models.comment import Comment, CommentObjectMixin
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.permission import Permission
 from grouper.models.permission_map import PermissionMap
 from grouper.models.user import User
@@ -167,7 +167,7 @@ class Group(Model, CommentObjectMixin):
         edge.apply_changes(request)
         self.session.flush()
 
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.membership, self.groupname)
 
     @flush_transaction
     def edit_member(self, requester, user_or_group, reason, **kwargs):
@@ -238,7 +238,7 @@ class Group(Model, CommentObjectMixin):
         AuditLog.log(self.session, requester.id, 'edit_member',
                      message, on_group_id=self.id)
 
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.membership, self.groupname)
 
     @flush_transaction
     def add_member(self, requester, user_or_group, reason, status="pending",
@@ -312,7 +312,7 @@ class Group(Model, CommentObjectMixin):
             edge.apply_changes(request)
             self.session.flush()
 
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.membership, self.groupname)
 
     def my_permissions(self):
 
@@ -531,11 +531,11 @@ class Group(Model, CommentObjectMixin):
 
     def enable(self):
         self.enabled = True
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.group, self.groupname)
 
     def disable(self):
         self.enabled = False
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.group, self.groupname)
 
     @staticmethod
     def get(session, pk=None, name=None):
@@ -547,7 +547,7 @@ class Group(Model, CommentObjectMixin):
 
     def add(self, session):
         super(Group, self).add(session)
-        Counter.incr(session, "updates")
+        GraphChange.record(session, GraphChangeType.group, self.groupname)
         return self
 
     def __repr__(self):
@@ -739,7 +739,7 @@ class Request(Model, CommentObjectMixin):
             ).one()
             edge.apply_changes(self)
 
-        Counter.incr(self.session, "updates")
+        GraphChange.record(self.session, GraphChangeType.membership, self.requesting.groupname)
 
 
 class RequestStatusChange(Model, CommentObjectMixin):
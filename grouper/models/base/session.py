@@ -4,6 +4,8 @@ import logging
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session as _Session, sessionmaker
 
+from grouper.query_stats import instrument_engine
+
 
 def flush_transaction(method):
     @functools.wraps(method)
@@ -25,7 +27,9 @@ def flush_transaction(method):
 
 
 def get_db_engine(url):
-    return create_engine(url, pool_recycle=300)
+    engine = create_engine(url, pool_recycle=300)
+    instrument_engine(engine)
+    return engine
 
 
 class Session(_Session):
@@ -0,0 +1,97 @@
+from datetime import datetime
+from enum import IntEnum
+
+from sqlalchemy import Column, DateTime, Integer, String
+
+from grouper.constants import MAX_NAME_LENGTH
+from grouper.models.base.model_base import Model
+from grouper.models.counter import Counter
+
+
+class GraphChangeType(IntEnum):
+    """Kinds of changes recorded in the graph_changes log. The name stored with each change
+    is a username for the user_* and public_key types, a groupname for group, membership and
+    grant, a permission name for permission and a tag name for tag."""
+
+    # a user was created, enabled, disabled or changed role
+    user = 1
+
+    # a group was created, enabled, disabled or edited (renames log both names)
+    group = 2
+
+    # the edges out of a group changed
+    membership = 3
+
+    # a permission changed its audit status
+    permission = 4
+
+    # the permissions granted to a group changed
+    grant = 5
+
+    # a user's public keys, or the tags on them, changed
+    public_key = 6
+
+    # a user's metadata changed
+    user_metadata = 7
+
+    # a user's passwords changed
+    user_password = 8
+
+    # a user's tokens changed
+    user_token = 9
+
+    # a public key tag or the permissions granted to it changed
+    tag = 10
+
+
+class GraphChange(Model):
+    """
+    A typed entry in the log of changes that bumped the "updates" counter. Every checkpoint
+    that has a matching row here can be applied to an in-memory graph as a delta; a checkpoint
+    without one (a bare Counter.incr) forces consumers to rebuild from scratch.
+    """
+
+    __tablename__ = "graph_changes"
+
+    id = Column(Integer, primary_key=True)
+    checkpoint = Column(Integer, unique=True, nullable=False)
+    change_type = Column(Integer, nullable=False)
+    name = Column(String(length=MAX_NAME_LENGTH), nullable=False)
+    created_on = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def record(cls, session, change_type, name):
+        """Bump the "updates" counter and log what changed in the same transaction.
+
+        Args:
+            session(models.base.session.Session): database session
+            change_type(GraphChangeType): what kind of object changed
+            name(str): name of the object that changed
+
+        Returns:
+            the new GraphChange row
+        """
+        counter = Counter.incr(session, "updates")
+        change = cls(checkpoint=counter.count, change_type=change_type, name=name).add(session)
+        session.flush()
+        return change
+
+    @staticmethod
+    def get_range(session, start, end):
+        """Return the changes with start <= checkpoint <= end, ordered by checkpoint."""
+        return session.query(GraphChange).filter(
+            GraphChange.checkpoint >= start,
+            GraphChange.checkpoint <= end,
+        ).order_by(GraphChange.checkpoint).all()
+
+    @staticmethod
+    def prune(session, before):
+        """Delete changes logged before the given datetime. Graphs older than that fall back to
+        a full rebuild on their next update."""
+        session.query(GraphChange).filter(GraphChange.created_on < before).delete()
+        session.commit()
+
+    def __repr__(self):
+        return "<%s: checkpoint=%s type=%s name=%s>" % (
+            type(self).__name__, self.checkpoint, GraphChangeType(self.change_type).name,
+            self.name)
@@ -7,7 +7,7 @@ from sqlalchemy.orm import relationship
 from grouper.constants import MAX_NAME_LENGTH
 from grouper.models.base.model_base import Model
 from grouper.models.comment import CommentObjectMixin
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.plugin import get_plugins
 
 
@@ -47,7 +47,7 @@ class User(Model, CommentObjectMixin):
 
     def add(self, session):
         super(User, self).add(session)
-        Counter.incr(session, "updates")
+        GraphChange.record(session, GraphChangeType.user, self.username)
         return self
 
     def is_member(self, members):
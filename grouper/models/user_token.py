@@ -59,13 +59,17 @@ class UserToken(Model):
         self.hashed_secret = hashlib.sha256(secret).hexdigest()
         return secret
 
-    def check_secret(self, secret):
-        # The length of self.hashed_secret is not secret
-        return self.enabled and hmac.compare_digest(
+    @staticmethod
+    def secret_matches(hashed_secret, secret):
+        # The length of hashed_secret is not secret
+        return hmac.compare_digest(
                 hashlib.sha256(secret).hexdigest(),
-                self.hashed_secret.encode('utf-8'),
+                hashed_secret.encode('utf-8'),
         )
 
+    def check_secret(self, secret):
+        return self.enabled and UserToken.secret_matches(self.hashed_secret, secret)
+
     @property
     def enabled(self):
         return self.disabled_at is None and self.user.enabled
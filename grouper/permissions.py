@@ -14,11 +14,12 @@ from grouper.models.audit_log import AuditLog
 from grouper.models.base.constants import OBJ_TYPES_IDX
 from grouper.models.base.session import Session  # noqa
 from grouper.models.comment import Comment
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.permission import Permission
 from grouper.models.permission_map import PermissionMap
 from grouper.models.permission_request import PermissionRequest
 from grouper.models.permission_request_status_change import PermissionRequestStatusChange
+from grouper.models.public_key_tag import PublicKeyTag
 from grouper.models.tag_permission_map import TagPermissionMap
 from grouper.plugin import get_plugins
 from grouper.user_group import get_groups_by_user
@@ -58,7 +59,8 @@ def grant_permission(session, group_id, permission_id, argument=''):
     mapping = PermissionMap(permission_id=permission_id, group_id=group_id, argument=argument)
     mapping.add(session)
 
-    Counter.incr(session, "updates")
+    group = Group.get(session, pk=group_id)
+    GraphChange.record(session, GraphChangeType.grant, group.groupname)
 
     session.commit()
 
@@ -87,7 +89,8 @@ def grant_permission_to_tag(session, tag_id, permission_id, argument=''):
         mapping = TagPermissionMap(permission_id=permission_id, tag_id=tag_id, argument=argument)
         mapping.add(session)
 
-        Counter.incr(session, "updates")
+        tag = PublicKeyTag.get(session, id=tag_id)
+        GraphChange.record(session, GraphChangeType.tag, tag.name)
     except IntegrityError:
         session.rollback()
         return False
@@ -113,7 +116,7 @@ def enable_permission_auditing(session, permission_name, actor_user_id):
     AuditLog.log(session, actor_user_id, 'enable_auditing', 'Enabled auditing.',
             on_permission_id=permission.id)
 
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.permission, permission.name)
 
     session.commit()
 
@@ -135,33 +138,11 @@ def disable_permission_auditing(session, permission_name, actor_user_id):
     AuditLog.log(session, actor_user_id, 'disable_auditing', 'Disabled auditing.',
             on_permission_id=permission.id)
 
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.permission, permission.name)
 
     session.commit()
 
 
-def get_groups_by_permission(session, permission):
-    """For a given permission, return the groups and associated arguments that
-    have that permission.
-
-    Args:
-        session(models.base.session.Session): database session
-        permission_name(Permission): permission in question
-
-    Returns:
-        List of 2-tuple of the form (Group, argument).
-    """
-    return session.query(
-        Group.groupname,
-        PermissionMap.argument,
-        PermissionMap.granted_on,
-    ).filter(
-        Group.id == PermissionMap.group_id,
-        PermissionMap.permission_id == permission.id,
-        Group.enabled == True,
-    ).all()
-
-
 def get_log_entries_by_permission(session, permission, limit=20):
     """For a given permission, return the audit logs that pertain.
 
@@ -6,7 +6,7 @@ import sshpubkey
 from sshpubkey.exc import PublicKeyParseError  # noqa
 
 from grouper.models.base.session import Session  # noqa
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.permission import Permission
 from grouper.models.public_key import PublicKey
 from grouper.models.public_key_tag import PublicKeyTag  # noqa
@@ -75,7 +75,7 @@ def add_public_key(session, user, public_key_str):
     )
     try:
         db_pubkey.add(session)
-        Counter.incr(session, "updates")
+        GraphChange.record(session, GraphChangeType.public_key, user.username)
     except IntegrityError:
         session.rollback()
         raise DuplicateKey()
@@ -103,9 +103,10 @@ def delete_public_key(session, user_id, key_id):
     for mapping in tag_mappings:
         remove_tag_from_public_key(session, pkey, mapping.tag)
 
+    username = pkey.user.username
     pkey.delete(session)
 
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.public_key, username)
 
     session.commit()
 
@@ -139,7 +140,7 @@ def add_tag_to_public_key(session, public_key, tag):
     mapping = PublicKeyTagMap(tag_id=tag.id, key_id=public_key.id)
     try:
         mapping.add(session)
-        Counter.incr(session, "updates")
+        GraphChange.record(session, GraphChangeType.public_key, public_key.user.username)
         session.commit()
     except IntegrityError:
         session.rollback()
@@ -164,7 +165,7 @@ def remove_tag_from_public_key(session, public_key, tag):
         raise TagNotOnKey()
 
     mapping.delete(session)
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.public_key, public_key.user.username)
     session.commit()
 
 
@@ -195,6 +196,14 @@ def get_public_key_tags(session, public_key):
     return [mapping.tag for mapping in mappings]
 
 
+def get_public_key_comment(public_key_str):
+    # type: (str) -> str
+    """Returns the comment of a public key as stored by add_public_key, which writes keys out
+    as "<type> <key> <comment>", without having to parse the key again."""
+    parts = public_key_str.split(" ", 2)
+    return parts[2] if len(parts) > 2 else ""
+
+
 def get_public_key_permissions(session, public_key):
     # type: (Session, PublicKey) -> List[Permission]
     """Returns the permissions that this public key has. Namely, this the set of permissions
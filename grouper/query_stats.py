@@ -0,0 +1,125 @@
+from collections import Counter
+import heapq
+import logging
+import re
+from time import time
+
+from expvar.stats import stats
+from sqlalchemy import event
+
+# Where a connection's QueryStats is kept in its info dict while a request's session holds it.
+QUERY_STATS_KEY = "grouper.query_stats"
+
+# How many of the slowest statements are kept for each request, and for each handler in
+# get_slowest_queries.
+NUM_SLOWEST = 5
+
+# The slowest statements seen so far for each handler class, as a heap of (ms, fingerprint).
+_slowest_by_handler = {}
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_PLACEHOLDER_RE = re.compile(r"\?|%s|%\(\w+\)s|:\w+")
+_PLACEHOLDER_LIST_RE = re.compile(r"\(\?(?:, \?)+\)")
+
+
+def fingerprint(statement):
+    """The statement with its literals and placeholders replaced by "?" and lists of them, as in
+    an IN clause, collapsed to "(?+)", so that statements that differ only by their parameters
+    have the same fingerprint."""
+    statement = _WHITESPACE_RE.sub(" ", statement).strip()
+    statement = _LITERAL_RE.sub("?", statement)
+    statement = _PLACEHOLDER_RE.sub("?", statement)
+    return _PLACEHOLDER_LIST_RE.sub("(?+)", statement)
+
+
+class QueryStats(object):
+    """The SQL statements run on behalf of one request: how many there were, how long they
+    took, and the slowest of them.
+
+    A request's session attaches its QueryStats to each connection it begins a transaction on,
+    and the statements run on that connection are recorded here until it's returned to the
+    pool. Engines must be set up with instrument_engine.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration_ms = 0.0
+        self.fingerprints = Counter()
+        self.slowest = []
+
+    def attach(self, connection):
+        connection.info[QUERY_STATS_KEY] = self
+
+    def record(self, statement, duration_ms):
+        statement = fingerprint(statement)
+        self.count += 1
+        self.duration_ms += duration_ms
+        self.fingerprints[statement] += 1
+        _push_slowest(self.slowest, (duration_ms, statement))
+
+    def summary(self):
+        return "{} queries, {}ms".format(self.count, int(self.duration_ms))
+
+    def report(self, handler_name, description, log_threshold=None):
+        """Add the statements to the db_queries and db_query_ms stats, overall and for the
+        given handler class, and to its slowest statements. If there were more than
+        log_threshold of them, log a warning listing their fingerprints."""
+        if not self.count:
+            return
+
+        stats.incr("db_queries", self.count)
+        stats.incr("db_queries_{}".format(handler_name), self.count)
+        stats.incr("db_query_ms", int(self.duration_ms))
+        stats.incr("db_query_ms_{}".format(handler_name), int(self.duration_ms))
+
+        slowest = _slowest_by_handler.setdefault(handler_name, [])
+        for item in self.slowest:
+            _push_slowest(slowest, item)
+
+        if log_threshold is not None and self.count > log_threshold:
+            logging.warning("%s (%s) ran %s:\n%s", description, handler_name, self.summary(),
+                            "\n".join("{:>6} x {}".format(count, statement)
+                                      for statement, count in self.fingerprints.most_common()))
+
+
+def _push_slowest(heap, item):
+    if len(heap) < NUM_SLOWEST:
+        heapq.heappush(heap, item)
+    else:
+        heapq.heappushpop(heap, item)
+
+
+def get_slowest_queries():
+    """The slowest statements reported for each handler class, slowest first."""
+    return {
+        handler_name: [
+            {"ms": int(duration_ms), "statement": statement}
+            for duration_ms, statement in sorted(slowest, reverse=True)
+        ]
+        for handler_name, slowest in _slowest_by_handler.iteritems()
+    }
+
+
+def instrument_engine(engine):
+    """Time each statement run on the engine's connections and record it in the QueryStats
+    attached to the connection, if any. Connections are detached when returned to the pool."""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if QUERY_STATS_KEY in conn.info:
+            conn.info.setdefault("grouper.query_start_times", []).append(time())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        query_stats = conn.info.get(QUERY_STATS_KEY)
+        start_times = conn.info.get("grouper.query_start_times")
+        if query_stats is not None and start_times:
+            query_stats.record(statement, (time() - start_times.pop()) * 1000)
+
+    def checkin(dbapi_connection, connection_record):
+        if connection_record is not None:
+            connection_record.info.pop(QUERY_STATS_KEY, None)
+            connection_record.info.pop("grouper.query_start_times", None)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine.pool, "checkin", checkin)
@@ -95,9 +95,14 @@ settings = Settings({
     "expiration_notice_days": 7,
     "nonauditor_expiration_days": 5,
     "from_addr": "no-reply@grouper.local",
+    "graph_backend": "networkx",
+    "graph_loader_threads": 1,
+    "graph_refresh_process": False,
+    "graph_snapshot_path": None,
     "log_format": "%(asctime)-15s\t%(levelname)s\t%(message)s",
     "oneoff_dir": None,
     "plugin_dir": None,
+    "request_query_log_threshold": None,
     "restricted_ownership_permissions": None,
     "send_emails": True,
     "sentry_dsn": None,
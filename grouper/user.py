@@ -8,7 +8,7 @@ from grouper.model_soup import (APPROVER_ROLE_INDICIES, Audit, Group, GROUP_EDGE
 from grouper.models.audit_log import AuditLog
 from grouper.models.base.session import Session  # noqa
 from grouper.models.comment import Comment
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
 from grouper.models.user import User
 from grouper.user_group import get_groups_by_user
 from grouper.user_permissions import user_is_group_admin
@@ -93,13 +93,13 @@ def enable_user(session, user, requester, preserve_membership):
                 )
 
     user.enabled = True
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.user, user.username)
 
 
 def disable_user(session, user):
     """Disables an enabled user"""
     user.enabled = False
-    Counter.incr(session, "updates")
+    GraphChange.record(session, GraphChangeType.user, user.username)
 
 
 def user_role_index(user, members):
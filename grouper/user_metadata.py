@@ -1,7 +1,8 @@
 import re
 
 from grouper.constants import PERMISSION_VALIDATION
-from grouper.models.counter import Counter
+from grouper.models.graph_change import GraphChange, GraphChangeType
+from grouper.models.user import User
 from grouper.models.user_metadata import UserMetadata
 
 
@@ -69,7 +70,8 @@ def set_user_metadata(session, user_id, data_key, data_value):
             user_md = UserMetadata(user_id=user_id, data_key=data_key, data_value=data_value)
             user_md.add(session)
 
-    Counter.incr(session, "updates")
+    user = User.get(session, pk=user_id)
+    GraphChange.record(session, GraphChangeType.user_metadata, user.username)
     session.commit()
 
     return user_md
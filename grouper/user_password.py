@@ -1,8 +1,8 @@
 from sqlalchemy.exc import IntegrityError
 
 from grouper.models.base.session import Session  # noqa
-from grouper.models.counter import Counter
-from grouper.models.user import User  # noqa
+from grouper.models.graph_change import GraphChange, GraphChangeType
+from grouper.models.user import User
 from grouper.models.user_password import UserPassword
 
 
@@ -26,7 +26,8 @@ def add_new_user_password(session, password_name, password, user_id):
     """
     p = UserPassword(name=password_name, user_id=user_id)
     p.set_password(password)
-    Counter.incr(session, "updates")
+    user = User.get(session, pk=user_id)
+    GraphChange.record(session, GraphChangeType.user_password, user.username)
     p.add(session)
     try:
         session.commit()
@@ -47,7 +48,8 @@ def delete_user_password(session, password_name, user_id):
     if not p:
         raise PasswordDoesNotExist()
     p.delete(session)
-    Counter.incr(session, "updates")
+    user = User.get(session, pk=user_id)
+    GraphChange.record(session, GraphChangeType.user_password, user.username)
     session.commit()
 
 
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import fnmatch
 import functools
 import logging
@@ -6,6 +7,8 @@ import subprocess
 import threading
 import time
 
+from expvar.stats import stats
+
 _TRUTHY = set([
     "true", "yes", "1", ""
 ])
@@ -81,3 +84,64 @@ def singleton(f):
                     initialized[0] = True
         return value[0]
     return wrapped
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entries once full.
+
+    By default max_size is a number of entries. Given size_of, it's instead a limit on the total
+    of size_of(value) over the cached values, e.g. len for strings to bound their bytes.
+
+    Hits, misses and evictions are counted in expvar stats as "<name>-cache-hit",
+    "<name>-cache-miss" and "<name>-cache-eviction", and the total size is kept in the
+    "<name>-cache-size" gauge.
+    """
+
+    def __init__(self, name, max_size, size_of=None):
+        self.name = name
+        self.max_size = max_size
+        self.size_of = size_of or (lambda value: 1)
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default if there isn't one."""
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                stats.incr("{}-cache-miss".format(self.name))
+                return default
+            self._data[key] = value
+        stats.incr("{}-cache-hit".format(self.name))
+        return value
+
+    def set(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self.size_of(self._data.pop(key))
+            self._data[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self.size_of(evicted)
+                stats.incr("{}-cache-eviction".format(self.name))
+            stats.set_gauge("{}-cache-size".format(self.name), self.size)
+
+    def get_or_set(self, key, compute):
+        """Return the value cached for key, calling compute() to fill it in on a miss."""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            # Compute outside of the lock; concurrent misses on the same key just both compute it.
+            value = compute()
+            self.set(key, value)
+        return value
@@ -1,6 +1,7 @@
 import pytest
 
 from grouper import model_soup
+from grouper.api.checkpoint_feed import CheckpointFeed
 from grouper.api.routes import HANDLERS as API_HANDLERS
 from grouper.app import Application
 from grouper.constants import AUDIT_MANAGER, PERMISSION_AUDITOR, USER_ADMIN
@@ -12,6 +13,7 @@ from grouper.models.base.model_base import Model
 from grouper.models.base.session import Session, get_db_engine
 from grouper.models.user import User
 from grouper.permissions import enable_permission_auditing
+from grouper.util import LRUCache
 from util import add_member, grant_permission
 from grouper.models.permission import Permission
 
@@ -182,10 +184,16 @@ def permissions(session, users):
 
 
 @pytest.fixture
-def api_app(session, standard_graph):
+def api_app(request, session, standard_graph):
+    checkpoint_feed = CheckpointFeed(standard_graph)
+    request.addfinalizer(checkpoint_feed.stop)
     my_settings = {
             "graph": standard_graph,
-            "db_session": lambda: session,
+            # The API closes its sessions, so it gets its own rather than the test's. It only
+            # reads, and sees whatever the test has committed.
+            "db_session": Session,
+            "checkpoint_feed": checkpoint_feed,
+            "response_cache": LRUCache("api-response", 1024 * 1024, size_of=len),
             }
     return Application(API_HANDLERS, my_settings=my_settings)
 
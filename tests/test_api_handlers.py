@@ -1,22 +1,41 @@
 import crypt
+from datetime import timedelta
 import json
 import hashlib
+import re
+import threading
 
 from urllib import urlencode
 
 import pytest
+from sqlalchemy import event
+from tornado import gen
+from tornado.httpclient import HTTPError
 
 from fixtures import api_app as app  # noqa
 from fixtures import standard_graph, graph, users, groups, session, permissions  # noqa
+from grouper.api import handlers
+from grouper.api.db_executor import DbExecutor
+from grouper.api.handlers import Export, UsersPublicKeys
 from grouper.constants import USER_METADATA_SHELL_KEY
+from grouper.models.base.session import Session
 from grouper.models.counter import Counter
 from grouper.models.permission import Permission
 from grouper.models.user_token import UserToken
+from grouper.public_key import add_public_key
+from grouper.query_stats import fingerprint
 from grouper.user_metadata import get_user_metadata_by_key, set_user_metadata
 from grouper.user_password import add_new_user_password, delete_user_password, user_passwords
 from grouper.user_token import add_new_user_token, disable_user_token
 from url_util import url
-from util import grant_permission
+from util import add_member, grant_permission
+
+key_1 = ('ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDCUQeasspT/etEJR2WUoR+h2sMOQYbJgr0Q'
+         'E+J8p97gEhmz107KWZ+3mbOwyIFzfWBcJZCEg9wy5Paj+YxbGONqbpXAhPdVQ2TLgxr41bNXvbcR'
+         'AxZC+Q12UZywR4Klb2kungKz4qkcmSZzouaKK12UxzGB3xQ0N+3osKFj3xA1+B6HqrVreU19XdVo'
+         'AJh0xLZwhw17/NDM+dAcEdMZ9V89KyjwjraXtOVfFhQF0EDF0ame8d6UkayGrAiXC2He0P2Cja+J'
+         '371P27AlNLHFJij8WGxvcGGSeAxMLoVSDOOllLCYH5UieV8mNpX1kNe2LeA58ciZb0AXHaipSmCH'
+         'gh/ some-comment')
 
 
 @pytest.mark.gen_test
@@ -133,6 +152,37 @@ def test_usertokens(users, session, http_client, base_url):
     assert body["errors"][0]["code"] == 3
 
 
+@pytest.mark.gen_test
+def test_usertokens_from_graph(users, session, http_client, base_url, graph):
+    user = users["zorkian@a.co"]
+    tok, secret = add_new_user_token(session, UserToken(user=user, name="Foo"))
+    session.commit()
+    graph.update_from_db(session)
+    assert graph.snapshot.user_tokens["zorkian@a.co"]["Foo"].enabled
+
+    api_url = url(base_url, '/token/validate')
+    resp = yield http_client.fetch(
+        api_url, method="POST", body=urlencode({'token': str(tok) + ":" + secret}))
+    body = json.loads(resp.body)
+    assert body["status"] == "ok"
+    assert body["data"]["identity"] == str(tok)
+
+    # A well-formed secret that isn't this token's.
+    resp = yield http_client.fetch(
+        api_url, method="POST", body=urlencode({'token': str(tok) + ":" + "0" * 40}))
+    body = json.loads(resp.body)
+    assert body["errors"][0]["code"] == 4
+
+    disable_user_token(session, tok)
+    session.commit()
+    graph.update_from_db(session)
+    assert not graph.snapshot.user_tokens["zorkian@a.co"]["Foo"].enabled
+
+    resp = yield http_client.fetch(
+        api_url, method="POST", body=urlencode({'token': str(tok) + ":" + secret}))
+    body = json.loads(resp.body)
+    assert body["errors"][0]["code"] == 3
+
 
 @pytest.mark.gen_test
 def test_permissions(permissions, http_client, base_url, session, graph):
@@ -164,6 +214,374 @@ def test_groups(groups, http_client, base_url):
 
     # TODO: test cutoff
 
+
+@pytest.mark.gen_test
+def test_changes_since(session, users, groups, http_client, base_url, graph):
+    checkpoint = graph.checkpoint
+    add_member(groups["team-sre"], users["zebu@a.co"])
+    add_member(groups["team-sre"], users["role@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+
+    # Role users are left out unless asked for, rather than reported as deleted.
+    resp = yield http_client.fetch(url(base_url, '/users', {'since': checkpoint}))
+    body = json.loads(resp.body)
+    assert resp.code == 200
+    assert body["checkpoint"] == graph.checkpoint
+    assert not body["data"]["resync"]
+    assert body["data"]["users"].keys() == ["zebu@a.co"]
+    assert "team-sre" in body["data"]["users"]["zebu@a.co"]["groups"]
+
+    resp = yield http_client.fetch(
+        url(base_url, '/users', {'since': checkpoint, 'include_role_users': 'yes'}))
+    body = json.loads(resp.body)
+    assert sorted(body["data"]["users"]) == ["role@a.co", "zebu@a.co"]
+
+    resp = yield http_client.fetch(url(base_url, '/groups', {'since': checkpoint}))
+    body = json.loads(resp.body)
+    # The groups above team-sre list its members too.
+    assert sorted(body["data"]["groups"]) == ["all-teams", "serving-team", "team-infra", "team-sre"]
+    assert "zebu@a.co" in body["data"]["groups"]["team-sre"]["users"]
+
+    resp = yield http_client.fetch(url(base_url, '/permissions', {'since': graph.checkpoint}))
+    body = json.loads(resp.body)
+    assert body["data"]["permissions"] == {}
+
+    # Too far back, or ahead of us, for the history to say what changed.
+    for since in (0, graph.checkpoint + 1):
+        resp = yield http_client.fetch(url(base_url, '/users', {'since': since}))
+        body = json.loads(resp.body)
+        assert body["data"]["resync"]
+        assert "users" not in body["data"]
+
+    for path in ('/users', '/groups', '/permissions', '/checkpoints'):
+        with pytest.raises(HTTPError) as e:
+            yield http_client.fetch(url(base_url, path, {'since': 'yesterday'}))
+        assert e.value.code == 400
+
+
+@pytest.mark.gen_test
+def test_etags(session, users, groups, http_client, base_url, graph):
+    @gen.coroutine
+    def fetch_status(path, etag):
+        try:
+            resp = yield http_client.fetch(url(base_url, path), headers={"If-None-Match": etag})
+        except HTTPError as e:
+            raise gen.Return(e.code)
+        raise gen.Return(resp.code)
+
+    etags = {}
+    for path in ('/users', '/users/zorkian@a.co', '/users/zebu@a.co'):
+        resp = yield http_client.fetch(url(base_url, path))
+        etags[path] = resp.headers["Etag"]
+        assert (yield fetch_status(path, etags[path])) == 304
+    assert len(set(etags.values())) == 3
+
+    # Only the user whose groups changed, and the list, which follows the checkpoint, are new.
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+    assert (yield fetch_status('/users', etags['/users'])) == 200
+    assert (yield fetch_status('/users/zorkian@a.co', etags['/users/zorkian@a.co'])) == 304
+    assert (yield fetch_status('/users/zebu@a.co', etags['/users/zebu@a.co'])) == 200
+
+
+@pytest.mark.gen_test
+def test_response_cache(session, users, groups, http_client, base_url, graph, app):
+    cache = app.my_settings["response_cache"]
+    first = yield http_client.fetch(url(base_url, '/users/zorkian@a.co', {'cutoff': 2}))
+    assert len(cache) == 1
+    second = yield http_client.fetch(url(base_url, '/users/zorkian@a.co', {'cutoff': 2}))
+    assert len(cache) == 1
+    assert second.body == first.body
+    assert second.headers["Content-Type"] == first.headers["Content-Type"]
+
+    # Not found, so not cached.
+    with pytest.raises(HTTPError):
+        yield http_client.fetch(url(base_url, '/users/nobody@a.co'))
+    assert len(cache) == 1
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+    third = yield http_client.fetch(url(base_url, '/users/zorkian@a.co', {'cutoff': 2}))
+    assert json.loads(third.body)["checkpoint"] == graph.checkpoint
+
+
+@pytest.mark.gen_test
+def test_batch(users, groups, http_client, base_url):
+    names = [("name", "zorkian@a.co"), ("name", "role@a.co"), ("name", "nobody@a.co")]
+    resp = yield http_client.fetch(url(base_url, '/users/batch'), method="POST",
+                                   body=urlencode(names))
+    body = json.loads(resp.body)
+    assert resp.code == 200
+    assert body["status"] == "ok"
+    assert sorted(body["data"]["users"]) == ["nobody@a.co", "role@a.co", "zorkian@a.co"]
+    assert body["data"]["users"]["zorkian@a.co"]["user"]["name"] == "zorkian@a.co"
+    assert body["data"]["users"]["role@a.co"]["user"]["role_user"]
+    assert body["data"]["users"]["nobody@a.co"] is None
+
+    resp = yield http_client.fetch(url(base_url, '/users/batch'), method="POST",
+                                   body=urlencode(names + [("include_role_users", "no")]))
+    body = json.loads(resp.body)
+    assert body["data"]["users"]["role@a.co"] is None
+
+    names = [("name", "team-sre"), ("name", "no-such-team")]
+    resp = yield http_client.fetch(url(base_url, '/groups/batch'), method="POST",
+                                   body=urlencode(names))
+    body = json.loads(resp.body)
+    assert resp.code == 200
+    assert body["data"]["groups"]["team-sre"]["group"]["name"] == "team-sre"
+    assert body["data"]["groups"]["no-such-team"] is None
+
+
+@pytest.mark.gen_test
+def test_public_keys(session, users, http_client, base_url):
+    add_public_key(session, users["zorkian@a.co"], key_1)
+
+    resp = yield http_client.fetch(url(base_url, '/public-keys'))
+    assert resp.code == 200
+    rows = [line.split(",") for line in resp.body.splitlines()]
+    assert rows[0] == ["username", "created_at", "type", "size", "fingerprint", "comment"]
+    assert len(rows) == 2
+    assert rows[1][0] == "zorkian@a.co"
+    assert rows[1][2] == "ssh-rsa"
+    assert rows[1][5] == "some-comment"
+
+    for args in ({'key_type': 'ssh-dss'}, {'since': '2100-01-01'}):
+        resp = yield http_client.fetch(url(base_url, '/public-keys', args))
+        assert len(resp.body.splitlines()) == 1
+
+    users["zorkian@a.co"].enabled = False
+    session.commit()
+    resp = yield http_client.fetch(url(base_url, '/public-keys', {'include_disabled': 'no'}))
+    assert len(resp.body.splitlines()) == 1
+    resp = yield http_client.fetch(url(base_url, '/public-keys'))
+    assert len(resp.body.splitlines()) == 2
+
+    with pytest.raises(HTTPError) as e:
+        yield http_client.fetch(url(base_url, '/public-keys', {'since': 'yesterday'}))
+    assert e.value.code == 400
+
+
+@pytest.mark.gen_test
+def test_export(users, groups, permissions, http_client, base_url, graph):
+    cache = graph.snapshot._details_cache
+    cached = len(cache)
+    for use_gzip in (True, False):
+        resp = yield http_client.fetch(url(base_url, '/export'), use_gzip=use_gzip)
+        assert resp.code == 200
+        assert resp.headers["X-Grouper-Checkpoint"] == str(graph.checkpoint)
+        assert (resp.headers.get("Content-Encoding") == "gzip") == use_gzip
+
+        lines = [json.loads(line) for line in resp.body.splitlines()]
+        assert sorted(l["name"] for l in lines if l["type"] == "user") == sorted(users)
+        assert sorted(l["name"] for l in lines if l["type"] == "group") == sorted(groups)
+        assert (sorted(l["name"] for l in lines if l["type"] == "permission") ==
+                sorted(graph.permissions))
+        by_name = {(l["type"], l["name"]): l["data"] for l in lines}
+        assert "team-sre" in by_name[("user", "zorkian@a.co")]["groups"]
+        assert by_name[("group", "team-sre")]["group"]["name"] == "team-sre"
+
+    # Exports leave the snapshot's shared details cache as they found it.
+    assert len(cache) == cached
+
+
+@gen.coroutine
+def abandon_stream(http_client, api_url, handler_class, monkeypatch, io_loop):
+    """Fetch a response streamed a line at a time by handler_class, whose flushes write but
+    never call back, as when the client has stopped reading, and give up on it partway through.
+    Returns whether the handler went on to finish."""
+    finished = []
+    real_flush = handler_class.flush
+    real_on_finish = handler_class.on_finish
+
+    def flush(self, include_footers=False, callback=None):
+        return real_flush(self, include_footers)
+
+    def on_finish(self):
+        finished.append(self)
+        real_on_finish(self)
+
+    monkeypatch.setattr(handlers, "EXPORT_CHUNK_LINES", 1)
+    monkeypatch.setattr(handler_class, "flush", flush)
+    monkeypatch.setattr(handler_class, "on_finish", on_finish)
+
+    with pytest.raises(HTTPError):
+        yield http_client.fetch(api_url, request_timeout=1)
+    for _ in xrange(100):
+        if finished:
+            break
+        yield gen.Task(io_loop.add_timeout, timedelta(milliseconds=10))
+    raise gen.Return(bool(finished))
+
+
+@pytest.mark.gen_test
+def test_export_disconnect(users, groups, permissions, http_client, base_url, io_loop,
+                           monkeypatch):
+    finished = yield abandon_stream(
+        http_client, url(base_url, '/export'), Export, monkeypatch, io_loop)
+    assert finished
+
+
+@pytest.mark.gen_test
+def test_public_keys_disconnect(session, users, http_client, base_url, io_loop, monkeypatch,
+                                app):
+    add_public_key(session, users["zorkian@a.co"], key_1)
+    closed = []
+
+    def open_session():
+        api_session = Session()
+        real_close = api_session.close
+
+        def close():
+            closed.append(api_session)
+            real_close()
+        api_session.close = close
+        return api_session
+    app.my_settings["db_session"] = open_session
+
+    finished = yield abandon_stream(
+        http_client, url(base_url, '/public-keys'), UsersPublicKeys, monkeypatch, io_loop)
+    assert finished
+    assert len(closed) == 1
+
+
+@pytest.mark.gen_test
+def test_lazy_sessions(session, users, groups, permissions, http_client, base_url, app):
+    opened = []
+
+    def open_session():
+        opened.append(session)
+        return session
+    app.my_settings["db_session"] = open_session
+
+    # Everything these need is in the graph.
+    for path in ('/users', '/users/zorkian@a.co', '/groups', '/groups/team-sre', '/permissions'):
+        yield http_client.fetch(url(base_url, path))
+    assert opened == []
+
+    yield http_client.fetch(url(base_url, '/public-keys'))
+    assert len(opened) == 1
+
+
+@pytest.mark.gen_test
+def test_query_stats(session, users, http_client, base_url, app):
+    app.settings["debug"] = True
+
+    # The graph hasn't been refreshed since the token was made, so it's looked up in the
+    # database: its owner, then the token itself.
+    tok, secret = add_new_user_token(session, UserToken(user=users["zorkian@a.co"], name="Foo"))
+    session.commit()
+    resp = yield http_client.fetch(url(base_url, '/token/validate'), method="POST",
+                                   body=urlencode({'token': str(tok) + ":" + secret}))
+    assert json.loads(resp.body)["status"] == "ok"
+    count, duration_ms = re.match(
+        r"^(\d+) queries, (\d+)ms$", resp.headers["X-Grouper-Queries"]).groups()
+    assert int(count) >= 2
+    assert 0 <= int(duration_ms) < 1000
+
+    resp = yield http_client.fetch(url(base_url, '/users/zorkian@a.co'))
+    assert resp.headers["X-Grouper-Queries"] == "0 queries, 0ms"
+
+    resp = yield http_client.fetch(url(base_url, '/debug/stats'))
+    slowest = json.loads(resp.body)["slowest_queries"]["TokenValidate"]
+    assert slowest and all(query["statement"].startswith("SELECT") for query in slowest)
+
+
+def test_fingerprint():
+    assert fingerprint("SELECT *\n  FROM users WHERE id IN (?, ?, ?) AND name = 'a''b'") == \
+        "SELECT * FROM users WHERE id IN (?+) AND name = ?"
+    assert fingerprint("SELECT * FROM users WHERE id = %(id_1)s LIMIT 10") == \
+        "SELECT * FROM users WHERE id = ? LIMIT ?"
+
+
+@pytest.mark.gen_test
+def test_db_executor(io_loop):
+    executor = DbExecutor(2)
+    try:
+        thread = yield executor.submit(threading.current_thread)
+        assert thread is not threading.current_thread()
+        with pytest.raises(ZeroDivisionError):
+            yield executor.submit(lambda: 1 / 0)
+        assert executor.queue_depth == 0
+    finally:
+        executor.close()
+
+
+@pytest.mark.gen_test
+def test_public_keys_executor(session, users, http_client, base_url, app):
+    add_public_key(session, users["zorkian@a.co"], key_1)
+    # One thread, since SQLite connections can't move between threads.
+    executor = DbExecutor(1)
+    app.my_settings["db_executor"] = executor
+    threads = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if "public_keys" in statement:
+            threads.append(threading.current_thread())
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        resp = yield http_client.fetch(url(base_url, '/public-keys'))
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        executor.close()
+
+    assert len(resp.body.splitlines()) == 2
+    assert threads
+    assert threading.current_thread() not in threads
+
+
+@pytest.mark.gen_test
+def test_checkpoint_stream(session, users, groups, http_client, base_url, graph, io_loop, app):
+    chunks = []
+
+    def events():
+        return [json.loads(line[len("data: "):])
+                for line in "".join(chunks).splitlines() if line.startswith("data: ")]
+
+    @gen.coroutine
+    def wait_for_events(count):
+        for _ in xrange(100):
+            if len(events()) >= count:
+                break
+            yield gen.Task(io_loop.add_timeout, timedelta(milliseconds=10))
+
+    checkpoint = graph.checkpoint
+    stream = http_client.fetch(
+        url(base_url, '/checkpoints', {'since': checkpoint}),
+        streaming_callback=chunks.append, request_timeout=1)
+
+    yield wait_for_events(1)
+    assert events() == [{
+        "checkpoint": checkpoint, "checkpoint_time": graph.checkpoint_time, "since": checkpoint,
+        "resync": False, "users": [], "groups": [], "permissions": [],
+    }]
+    feed = app.my_settings["checkpoint_feed"]
+    assert all(handler.snapshot is None for handler in feed.streams)
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+    yield wait_for_events(2)
+    assert len(events()) == 2
+    assert events()[1]["checkpoint"] == graph.checkpoint
+    assert events()[1]["since"] == checkpoint
+    assert events()[1]["users"] == ["zebu@a.co"]
+    assert events()[1]["groups"] == ["sad-team"]
+
+    # The stream stays open until the client gives up on it.
+    with pytest.raises(HTTPError):
+        yield stream
+    for _ in xrange(100):
+        if not feed.streams:
+            break
+        yield gen.Task(io_loop.add_timeout, timedelta(milliseconds=10))
+    assert not feed.streams
+
+
 @pytest.mark.gen_test
 def test_shell(session, users, http_client, base_url, graph):
     user = users['zorkian@a.co']
@@ -639,3 +639,12 @@ def test_disable_service_account(session, users, http_client, base_url):
     assert not u.enabled, "Attempting to enable SAs through groups/enable should not work"
     g = Group.get(session, name="bob@svc.localhost")
     assert not g.enabled, "Attempting to enable SAs through groups/enable should not work"
+
+
+@pytest.mark.gen_test
+def test_permission_view(session, standard_graph, http_client, base_url):
+    fe_url = url(base_url, '/permissions/ssh')
+    resp = yield http_client.fetch(fe_url, headers={'X-Grouper-User': 'zorkian@a.co'})
+    assert resp.code == 200
+    for grant in standard_graph.get_permission_grants('ssh'):
+        assert '/groups/{}'.format(grant.groupname) in resp.body
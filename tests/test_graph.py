@@ -0,0 +1,448 @@
+from contextlib import contextmanager
+import time
+
+from fixtures import standard_graph, graph, users, groups, session, permissions  # noqa
+from mock import patch
+import pytest
+from sqlalchemy import event
+from util import add_member, grant_permission, revoke_member
+
+from grouper.database import GraphRefreshWorker, SnapshotFollowThread
+from grouper.graph import GroupGraph, NoSuchGroup
+from grouper.graph_backends import GRAPH_BACKENDS
+from grouper.model_soup import Group
+from grouper.models.counter import Counter
+from grouper.models.public_key_tag import PublicKeyTag
+from grouper.public_key import add_public_key, add_tag_to_public_key
+from grouper.service_account import create_service_account
+from grouper.settings import Settings, settings
+from grouper.user import disable_user
+from grouper.user_metadata import set_user_metadata
+from grouper.util import LRUCache
+
+key_1 = ('ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDCUQeasspT/etEJR2WUoR+h2sMOQYbJgr0Q'
+         'E+J8p97gEhmz107KWZ+3mbOwyIFzfWBcJZCEg9wy5Paj+YxbGONqbpXAhPdVQ2TLgxr41bNXvbcR'
+         'AxZC+Q12UZywR4Klb2kungKz4qkcmSZzouaKK12UxzGB3xQ0N+3osKFj3xA1+B6HqrVreU19XdVo'
+         'AJh0xLZwhw17/NDM+dAcEdMZ9V89KyjwjraXtOVfFhQF0EDF0ame8d6UkayGrAiXC2He0P2Cja+J'
+         '371P27AlNLHFJij8WGxvcGGSeAxMLoVSDOOllLCYH5UieV8mNpX1kNe2LeA58ciZb0AXHaipSmCH'
+         'gh/ some-comment')
+key_2 = ("ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDF1DyXlqc40AVUgt/IO0GFcTniaoFt5qCUAeNVlva"
+         "lMnsrRULIXkb0g1ds9P9/UI2jWr70ZYG7XieQX1F7NpzaDeUyPGCrLV1/ev1ZtUImCrDFfMznEjkcqB"
+         "33mRe1rCFGKNVOYUviPE1yBdbfZBGUuJBX2GOXQQj9fU4Hiq3rAgOhz89717mt+qZxZllZ4mdyVEaMB"
+         "WCwqAvl7Z5ecDjB+llFpBORTmsT8OZoGbZnJTIB1d9j0tSbegP17emE+g9fTrk4/ePmSIAKcSV3xj6h"
+         "98AGesNibyu9eKVrroEptxX4crl0o95Me6B1/DCL632xrTO0a5mSmlF4cxCgjLj9 to/ key2")
+
+
+def assert_same_graph(graph, other):
+    assert set(graph.nodes) == set(other.nodes)
+    assert sorted(graph.snapshot.graph.edges()) == sorted(other.snapshot.graph.edges())
+    assert graph.users == other.users
+    assert graph.groups == other.groups
+    assert graph.permissions == other.permissions
+    assert graph.user_metadata == other.user_metadata
+    assert graph.group_metadata == other.group_metadata
+    assert graph.permission_metadata == other.permission_metadata
+    assert graph.permission_tuples == other.permission_tuples
+    assert graph.group_tuples == other.group_tuples
+    assert graph.disabled_group_tuples == other.disabled_group_tuples
+    assert graph.checkpoint == other.checkpoint
+    assert ({name: (set(c.groups), set(c.permissions))
+             for name, c in graph.user_closures.items()} ==
+            {name: (set(c.groups), set(c.permissions))
+             for name, c in other.user_closures.items()})
+
+
+@pytest.mark.parametrize("backend", sorted(GRAPH_BACKENDS))
+def test_graph_delta_update(session, standard_graph, users, groups, permissions, backend):  # noqa
+    graph = GroupGraph.from_db(session, backend=backend)
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    add_member(groups["sad-team"], groups["audited-team"])
+    revoke_member(groups["team-sre"], users["zay@a.co"])
+    grant_permission(groups["sad-team"], permissions["sudo"], argument="shell")
+    add_public_key(session, users["oliver@a.co"], key_1)
+    set_user_metadata(session, users["gary@a.co"].id, "shell", "/bin/zsh")
+    disable_user(session, users["figurehead@a.co"])
+    groups["tech-ops"].disable()
+    session.commit()
+
+    with patch.object(GroupGraph, "_rebuild_from_db") as rebuild:
+        graph.update_from_db(session)
+        assert not rebuild.called
+
+    assert_same_graph(graph, GroupGraph.from_db(session, backend=backend))
+    assert "zebu@a.co" in graph.get_group_details("sad-team")["users"]
+    assert "tech-ops" not in graph.groups
+
+
+def test_graph_delta_gap(session, standard_graph, users, groups):  # noqa
+    graph = GroupGraph.from_db(session)
+
+    # A bare counter bump leaves a hole in the change log, forcing a full rebuild.
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    Counter.incr(session, "updates")
+    session.commit()
+
+    with patch.object(GroupGraph, "_apply_changes_from_db") as apply_changes:
+        graph.update_from_db(session)
+        assert not apply_changes.called
+
+    assert_same_graph(graph, GroupGraph.from_db(session))
+
+
+def test_user_details_cutoff(session, standard_graph):  # noqa
+    graph = standard_graph
+
+    details = graph.get_user_details("gary@a.co")
+    assert details["groups"]["all-teams"]["path"] == ["gary@a.co", "team-infra", "all-teams"]
+    assert details["groups"]["all-teams"]["distance"] == 2
+
+    details = graph.get_user_details("gary@a.co", cutoff=1)
+    assert set(details["groups"]) == {"team-sre", "tech-ops", "team-infra"}
+    assert {p["distance"] for p in details["permissions"]} == {1}
+
+    # np-owners get the group but none of its permissions.
+    details = graph.get_user_details("figurehead@a.co")
+    assert details["groups"]["tech-ops"]["rolename"] == "np-owner"
+    assert "serving-team" not in details["groups"]
+    ssh_arguments = {p["argument"] for p in details["permissions"] if p["permission"] == "ssh"}
+    assert "shell" not in ssh_arguments
+
+
+def summarize_members(details):
+    """Drop paths, which may differ between backends when there are ties."""
+    return {key: {name: (member["distance"], member["role"]) for name, member in value.items()}
+            for key, value in details.items() if key in ("users", "groups", "subgroups")}
+
+
+def test_backends_agree(session, standard_graph):  # noqa
+    graphs = [GroupGraph.from_db(session, backend=backend) for backend in sorted(GRAPH_BACKENDS)]
+    expected = graphs[0]
+
+    for backend_graph in graphs[1:]:
+        assert set(backend_graph.nodes) == set(expected.nodes)
+        assert (sorted(backend_graph.snapshot.graph.edges()) ==
+                sorted(expected.snapshot.graph.edges()))
+        for groupname in expected.groups:
+            for cutoff in (None, 1, 2):
+                details = backend_graph.get_group_details(groupname, cutoff=cutoff)
+                expected_details = expected.get_group_details(groupname, cutoff=cutoff)
+                assert summarize_members(details) == summarize_members(expected_details)
+        for username in expected.users:
+            assert (summarize_members(backend_graph.get_user_details(username)) ==
+                    summarize_members(expected.get_user_details(username)))
+        assert backend_graph.get_groups(audited=True) == expected.get_groups(audited=True)
+        assert backend_graph.get_permission_details("ssh") == expected.get_permission_details("ssh")
+
+
+def test_snapshot_swap(session, standard_graph, users, groups):  # noqa
+    graph = GroupGraph.from_db(session)
+    snapshot = graph.snapshot
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+
+    # Readers holding the old snapshot keep seeing the old checkpoint.
+    assert graph.snapshot is not snapshot
+    assert snapshot.checkpoint < graph.checkpoint
+    assert "zebu@a.co" not in snapshot.get_group_details("sad-team")["users"]
+    assert "zebu@a.co" in graph.get_group_details("sad-team")["users"]
+
+
+def test_details_cache(session, standard_graph, users, groups):  # noqa
+    graph = GroupGraph.from_db(session)
+
+    details = graph.get_group_details("team-sre")
+    assert graph.get_group_details("team-sre") is details
+    assert graph.get_group_details("team-sre", cutoff=1) is not details
+    assert graph.get_user_details("gary@a.co") is graph.get_user_details("gary@a.co")
+    assert graph.get_permission_details("ssh") is graph.get_permission_details("ssh")
+
+    # A new snapshot starts with an empty cache.
+    add_member(groups["team-sre"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+    assert "zebu@a.co" in graph.get_group_details("team-sre")["users"]
+    assert "zebu@a.co" not in details["users"]
+
+
+def test_lru_cache():
+    cache = LRUCache("test", 2)
+    cache.get_or_set("a", lambda: 1)
+    cache.get_or_set("b", lambda: 2)
+    assert cache.get_or_set("a", lambda: 3) == 1
+
+    # "b" is now the least recently used, so it's the one evicted.
+    cache.get_or_set("c", lambda: 3)
+    assert len(cache) == 2
+    assert cache.get_or_set("a", lambda: 4) == 1
+    assert cache.get_or_set("b", lambda: 5) == 5
+
+
+def test_lru_cache_size_of():
+    cache = LRUCache("test", 10, size_of=len)
+    cache.set("a", "12345")
+    cache.set("b", "1234")
+    assert cache.size == 9
+
+    # Evicts as many of the oldest as it takes to fit, and never keeps anything too big.
+    cache.set("c", "123456")
+    assert cache.get("a") is None
+    assert cache.get("b") == "1234"
+    assert cache.size == 10
+    cache.set("d", "12345678901")
+    assert cache.get("d") is None
+    assert cache.size == 10
+
+
+def test_parallel_load(session, standard_graph):  # noqa
+    graph = GroupGraph.from_db(session, loader_threads=4)
+    assert_same_graph(graph, GroupGraph.from_db(session))
+
+    # If anything is committed mid-load, fall back to loading sequentially.
+    with patch.object(GroupGraph, "_get_checkpoint", side_effect=[(1, 0), (1, 0), (2, 0)]):
+        with patch.object(GroupGraph, "_get_user_metadata", return_value={}) as user_metadata:
+            graph = GroupGraph(loader_threads=4)
+            graph.update_from_db(session)
+            assert user_metadata.call_count == 2
+
+
+@contextmanager
+def count_queries(session):
+    """Count the SQL statements run on the session's engine within the block."""
+    engine = session.get_bind()
+    count = [0]
+
+    def before_cursor_execute(*args):
+        count[0] += 1
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    # Connections only pick up listeners when checked out, so start a fresh one.
+    session.commit()
+    try:
+        yield count
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_refresh_query_count(session, standard_graph, users, groups, permissions):  # noqa
+    with count_queries(session) as before:
+        GroupGraph.from_db(session)
+
+    # More groups, service accounts, grants and tagged keys must not mean more queries.
+    tag = PublicKeyTag(name="tag", description="a tag")
+    tag.add(session)
+    for i in range(10):
+        group = Group(groupname="group-%d" % i, description="", canjoin="canjoin")
+        group.add(session)
+        add_member(group, users["gary@a.co"])
+        grant_permission(group, permissions["ssh"], argument=str(i))
+        create_service_account(session, users["zay@a.co"], "service-%d" % i, "", "canask")
+    for username, key in (("gary@a.co", key_1), ("zay@a.co", key_2)):
+        public_key = add_public_key(session, users[username], key)
+        add_tag_to_public_key(session, public_key, tag)
+    session.commit()
+
+    with count_queries(session) as after:
+        graph = GroupGraph.from_db(session)
+
+    assert after[0] == before[0]
+    assert graph.group_tuples["service-1"].service_account
+    assert not graph.group_tuples["group-1"].service_account
+    assert graph.user_metadata["zay@a.co"]["public_keys"][0]["tags"] == ["tag"]
+
+
+def test_snapshot_file(session, standard_graph, users, groups, tmpdir):  # noqa
+    path = str(tmpdir.join("graph.snapshot"))
+    graph = GroupGraph.from_db(session)
+    graph.save_snapshot(path)
+
+    loaded = GroupGraph()
+    assert loaded.load_snapshot(path)
+    assert_same_graph(loaded, graph)
+    assert loaded.get_group_details("team-sre") == graph.get_group_details("team-sre")
+
+    # A warm-started graph catches up by applying just the changes since it was saved.
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    with patch.object(GroupGraph, "_rebuild_from_db") as rebuild:
+        loaded.update_from_db(session)
+        assert not rebuild.called
+    assert "zebu@a.co" in loaded.get_group_details("sad-team")["users"]
+
+    assert not GroupGraph().load_snapshot(str(tmpdir.join("missing")))
+    tmpdir.join("garbage").write("not a snapshot")
+    assert not GroupGraph().load_snapshot(str(tmpdir.join("garbage")))
+
+
+def test_refresh_worker(session, standard_graph, users, groups, tmpdir):  # noqa
+    path = str(tmpdir.join("graph.snapshot"))
+    worker_settings = Settings.from_settings(settings, {
+        "database": "sqlite:///%s" % tmpdir.join("grouper.sqlite"),
+        "graph_snapshot_path": path,
+    })
+
+    graph = GroupGraph()
+    worker = GraphRefreshWorker()
+    try:
+        assert worker.update(graph, worker_settings)
+        assert_same_graph(graph, standard_graph)
+        assert not worker.update(graph, worker_settings)
+
+        add_member(groups["sad-team"], users["zebu@a.co"])
+        session.commit()
+        assert worker.update(graph, worker_settings)
+        assert "zebu@a.co" in graph.get_group_details("sad-team")["users"]
+    finally:
+        worker.close()
+
+    # The worker keeps the snapshot file up to date.
+    loaded = GroupGraph()
+    assert loaded.load_snapshot(path)
+    assert_same_graph(loaded, graph)
+
+
+def test_snapshot_follow(session, standard_graph, users, groups, tmpdir):  # noqa
+    path = str(tmpdir.join("graph.snapshot"))
+    builder = GroupGraph.from_db(session)
+    builder.save_snapshot(path)
+
+    follower = GroupGraph()
+    thread = SnapshotFollowThread(follower, path, 0.01)
+    thread.daemon = True
+    thread.start()
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    builder.update_from_db(session)
+    builder.save_snapshot(path)
+    for _ in xrange(500):
+        if follower.checkpoint == builder.checkpoint:
+            break
+        time.sleep(0.01)
+    assert_same_graph(follower, builder)
+    assert "zebu@a.co" in follower.get_group_details("sad-team")["users"]
+
+
+def normalize(value):
+    """Sort the lists in value, whose order isn't meaningful in graph details."""
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.iteritems()}
+    if isinstance(value, (list, tuple)):
+        return sorted((normalize(v) for v in value), key=repr)
+    return value
+
+
+def assert_changes_cover(old, new):
+    """Everything whose details differ between the two snapshots is listed as changed."""
+    changes = new.get_changes_since(old.checkpoint)
+
+    def user(snapshot, name):
+        if name not in snapshot.users:
+            return None
+        return snapshot.user_metadata.get(name), normalize(snapshot.get_user_details(name))
+
+    def group(snapshot, name):
+        if name not in snapshot.groups:
+            return None
+        return snapshot.group_metadata.get(name), normalize(snapshot.get_group_details(name))
+
+    def permission(snapshot, name):
+        if name not in snapshot.permissions:
+            return None
+        return normalize(snapshot.get_permission_details(name))
+
+    for name in old.users | new.users:
+        assert name in changes.users or user(old, name) == user(new, name)
+    for name in old.groups | new.groups:
+        assert name in changes.groups or group(old, name) == group(new, name)
+    for name in old.permissions | new.permissions:
+        assert name in changes.permissions or permission(old, name) == permission(new, name)
+    return changes
+
+
+def test_changes_since(session, standard_graph, users, groups, permissions):  # noqa
+    graph = standard_graph
+    first = graph.snapshot
+    changes = graph.get_changes_since(first.checkpoint)
+    assert not (changes.users or changes.groups or changes.permissions)
+    assert graph.get_changes_since(first.checkpoint + 1) is None
+
+    add_member(groups["sad-team"], users["zebu@a.co"])
+    session.commit()
+    graph.update_from_db(session)
+    changes = assert_changes_cover(first, graph.snapshot)
+    assert changes.users == {"zebu@a.co"}
+    assert changes.groups == {"sad-team"}
+    assert not changes.permissions
+
+    previous = graph.snapshot
+    Group(groupname="new-group", description="", canjoin="canjoin").add(session)
+    session.commit()
+    graph.update_from_db(session)
+    changes = assert_changes_cover(previous, graph.snapshot)
+    assert changes.groups == {"new-group"}
+
+    steps = [
+        lambda: add_member(groups["sad-team"], groups["audited-team"]),
+        lambda: grant_permission(groups["team-infra"], permissions["team-sre"]),
+        lambda: revoke_member(groups["team-sre"], users["zay@a.co"]),
+        lambda: disable_user(session, users["oliver@a.co"]),
+    ]
+    for step in steps:
+        previous = graph.snapshot
+        step()
+        session.commit()
+        graph.update_from_db(session)
+        assert_changes_cover(previous, graph.snapshot)
+        assert_changes_cover(first, graph.snapshot)
+
+    # A full rebuild compares the whole graph.
+    rebuilt = GroupGraph()
+    rebuilt.snapshot = first
+    rebuilt.update_from_db(session)
+    changes = assert_changes_cover(first, rebuilt.snapshot)
+    assert "tyleromeara@a.co" not in changes.users
+
+    with patch("grouper.graph.DELTA_HISTORY_SIZE", 2):
+        for name in ("team-sre", "tech-ops", "sad-team"):
+            grant_permission(groups[name], permissions["sudo"], argument=name)
+            session.commit()
+            graph.update_from_db(session)
+    assert graph.get_changes_since(first.checkpoint) is None
+
+
+def test_permission_details(session, standard_graph):  # noqa
+    graph = standard_graph
+
+    for name in graph.permissions:
+        details = graph.get_permission_details(name)
+        inheriting = {
+            groupname for groupname in graph.groups
+            if name in {p["permission"] for p in graph.get_group_details(groupname)["permissions"]}
+        }
+        assert set(details["groups"]) == inheriting
+        for groupname, group_details in details["groups"].iteritems():
+            assert group_details == graph.get_group_details(groupname, show_permission=name)
+
+        grants = graph.get_permission_grants(name)
+        assert [grant.groupname for grant in grants] == sorted(grant.groupname for grant in grants)
+        assert {grant.groupname for grant in grants} <= inheriting
+
+
+def test_audited_groups(session, standard_graph):  # noqa
+    graph = standard_graph
+
+    audited = {g for g in graph.groups if graph.get_group_details(g)["audited"]}
+    assert "audited-team" in audited and "serving-team" in audited
+    assert graph.audited_groups == audited
+    assert graph.directly_audited_groups <= graph.audited_groups
+    assert {g.groupname for g in graph.get_groups(audited=True)} == audited
+    assert {g.groupname for g in graph.get_groups(directly_audited=True)} == {
+        "audited-team", "serving-team"}
+
+    for groupname in graph.groups:
+        assert graph.is_group_audited(groupname) == (groupname in audited)
+    with pytest.raises(NoSuchGroup):
+        graph.is_group_audited("not-a-group")
@@ -10,6 +10,7 @@ from grouper.constants import (
 )
 
 from ctl_util import call_main
+from grouper.graph import GroupGraph
 from grouper.model_soup import Group
 from grouper.models.base.model_base import Model
 from grouper.models.user import User
@@ -175,3 +176,16 @@ def test_oneoff(mock_make_session, mock_annex, mock_load_plugins, session):
 
     call_main('oneoff', 'run', '--no-dry_run', 'FakeOneOff', 'key=valuewith=')
     assert User.get(session, name=other_username) is not None, '"valuewith= in arg, create user2'
+
+
+@patch('grouper.ctl.graph.make_session')
+def test_graph_benchmark(make_session, session, standard_graph):
+    make_session.return_value = session
+
+    with patch('grouper.ctl.graph.GroupGraph.from_db', wraps=GroupGraph.from_db) as from_db:
+        call_main('graph', 'benchmark', '--backend', 'compact')
+        from_db.assert_called_once_with(session, backend='compact', loader_threads=1)
+
+        from_db.reset_mock()
+        call_main('graph', 'benchmark')
+        assert from_db.call_count == 2
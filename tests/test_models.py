@@ -8,8 +8,6 @@ from fixtures import (
 )  # noqa
 
 from grouper.model_soup import GROUP_EDGE_ROLES, Group
-from grouper.permissions import get_groups_by_permission
-from grouper.models.permission import Permission
 
 
 def test_group_edge_roles_order_unchanged():
@@ -24,8 +22,9 @@ def test_group_edge_roles_order_unchanged():
 
 def test_permission_exclude_inactive(session, standard_graph):
     """Ensure disabled groups are excluded from permission data."""
-    group = Group.get(session, name="team-sre")
-    permission = Permission.get(session, name="ssh")
-    assert "team-sre" in [g[0] for g in get_groups_by_permission(session, permission)]
-    group.disable()
-    assert "team-sre" not in [g[0] for g in get_groups_by_permission(session, permission)]
+    graph = standard_graph
+    assert "team-sre" in [g.groupname for g in graph.get_permission_grants("ssh")]
+    Group.get(session, name="team-sre").disable()
+    session.commit()
+    graph.update_from_db(session)
+    assert "team-sre" not in [g.groupname for g in graph.get_permission_grants("ssh")]
@@ -76,5 +76,15 @@ def test_tags(session, users, http_client, base_url, graph):
     pub_key = body['data']['user']['public_keys'][0]
     assert len(pub_key['tags']) == 1, "The public key should only have 1 tag"
     assert pub_key['tags'][0] == 'tyler_was_here', "The public key should have the tag we gave it"
-    #assert len(pub_key['permissions']) == 1, "The public key should only have 1 permission"
-    #assert pub_key['permissions'][0] == [TAG_EDIT, "prod"], "The public key should only have permissions that are the intersection of the user's permissions and the tag's permissions"
+    assert len(pub_key['permissions']) == 1, "The public key should only have 1 permission"
+    assert pub_key['permissions'][0] == [TAG_EDIT, "prod"], "The public key should only have permissions that are the intersection of the user's permissions and the tag's permissions"
+
+    # Changes to the tag's permissions reach the key with the next graph update.
+    grant_permission_to_tag(session, tag.id, perm2.id, "foo")
+    graph.update_from_db(session)
+
+    resp = yield http_client.fetch(fe_url)
+    body = json.loads(resp.body)
+    pub_key = body['data']['user']['public_keys'][0]
+    assert sorted(pub_key['permissions']) == sorted([
+        ["it.literally.does.not.matter", "foo"], [TAG_EDIT, "prod"]])